@@ -3,18 +3,30 @@ import csv
 import itertools
 
 
-def evaluateDuplicates(found_dupes, true_dupes):
+def precisionRecall(found_dupes, true_dupes):
     true_positives = found_dupes.intersection(true_dupes)
     false_positives = found_dupes.difference(true_dupes)
 
+    if found_dupes:
+        precision = 1 - len(false_positives) / float(len(found_dupes))
+    else:
+        precision = 0.0
+    recall = len(true_positives) / float(len(true_dupes))
+
+    return precision, recall
+
+
+def evaluateDuplicates(found_dupes, true_dupes):
+    precision, recall = precisionRecall(found_dupes, true_dupes)
+
     print("found duplicate")
     print(len(found_dupes))
 
     print("precision")
-    print(1 - len(false_positives) / float(len(found_dupes)))
+    print(precision)
 
     print("recall")
-    print(len(true_positives) / float(len(true_dupes)))
+    print(recall)
 
 
 def dupePairs(filename, rowname):
@@ -37,10 +49,11 @@ def dupePairs(filename, rowname):
     return dupe_s
 
 
-manual_clusters = "csv_example_input_with_true_ids.csv"
-dedupe_clusters = "csv_example_output.csv"
+if __name__ == "__main__":
+    manual_clusters = "csv_example_input_with_true_ids.csv"
+    dedupe_clusters = "csv_example_output.csv"
 
-true_dupes = dupePairs(manual_clusters, "True Id")
-test_dupes = dupePairs(dedupe_clusters, "Cluster ID")
+    true_dupes = dupePairs(manual_clusters, "True Id")
+    test_dupes = dupePairs(dedupe_clusters, "Cluster ID")
 
-evaluateDuplicates(test_dupes, true_dupes)
+    evaluateDuplicates(test_dupes, true_dupes)
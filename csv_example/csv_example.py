@@ -10,49 +10,101 @@ compiled from several different sources.
 
 The output will be a CSV with our clustered results.
 
-For larger datasets, see our [mysql_example](mysql_example.html)
+For larger datasets, see our [mysql_example](mysql_example.html), or
+[csv_example_sqlite](csv_example_sqlite.html), which keeps the records
+in a local SQLite file instead of in memory.
 """
 
-import csv
 import logging
 import optparse
 import os
-import re
+import sys
 
 import dedupe
-from unidecode import unidecode
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.arrowio import read_records, row_index_for, write_results_file
+from shared.blockcache import BlockKeyCache, partition
+from shared.labeling import console_label
+from shared.normalize import Normalizer
+from shared.records import RecordStore
+from shared.results import ClusterMembership
 
-def preProcess(column):
+
+# Do a little bit of data cleaning with the help of Unidecode and Regex.
+# Things like casing, extra spaces, quotes and new lines can be ignored.
+# If data is missing, indicate that by setting the value to `None`.
+preProcess = Normalizer([("  +", " "), ("\n", " ")])
+
+
+# The fields our data model compares. These are the only columns we
+# keep in memory.
+MODEL_FIELDS = ("Site name", "Address", "Zip", "Phone")
+
+
+def cleanRow(row):
+    return {k: preProcess(v) for (k, v) in row.items()}
+
+
+def readData(filename, row_index=None):
     """
-    Do a little bit of data cleaning with the help of Unidecode and Regex.
-    Things like casing, extra spaces, quotes and new lines can be ignored.
+    Read in our data from a CSV or a Parquet file and create a dictionary
+    of records, where the key is a unique record ID and each value is dict
+
+    If there is a `row_index`, it learns where each record's row is in
+    the file, so we can read the whole row again when we need it.
     """
-    column = unidecode(column)
-    column = re.sub("  +", " ", column)
-    column = re.sub("\n", " ", column)
-    column = column.strip().strip('"').strip("'").lower().strip()
-    # If data is missing, indicate that by setting the value to `None`
-    if not column:
-        column = None
-    return column
+
+    return read_records(
+        filename,
+        cleanRow,
+        id_column="Id",
+        data_d=RecordStore(MODEL_FIELDS),
+        row_index=row_index,
+    )
 
 
-def readData(filename):
+def collapseDuplicates(data_d, fields):
     """
-    Read in our data from a CSV file and create a dictionary of records,
-    where the key is a unique record ID and each value is dict
+    Group the records that are identical in every field dedupe looks
+    at. Returns a dictionary with one representative record per group,
+    and a dictionary from the ID of each representative to the IDs of
+    all the records in its group.
+
+    This changes the clusters a little, it isn't only faster. The
+    records of a group always end up in the same cluster, and a
+    representative is clustered as if it were a single record, whatever
+    the size of its group, which is only used to expand the clusters
+    afterwards.
     """
 
-    data_d = {}
-    with open(filename) as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            clean_row = [(k, preProcess(v)) for (k, v) in row.items()]
-            row_id = int(row["Id"])
-            data_d[row_id] = dict(clean_row)
+    representatives = {}
+    members = {}
+    seen = {}
+    for record_id, record in data_d.items():
+        key = tuple(record[field] for field in fields)
+        rep_id = seen.setdefault(key, record_id)
+        if rep_id == record_id:
+            representatives[record_id] = record
+            members[record_id] = []
+        members[rep_id].append(record_id)
+
+    return representatives, members
+
+
+def expandClusters(clustered_dupes, members):
+    """
+    Replace every representative in the clusters with all the records
+    in its group, each with the representative's confidence score.
+    """
 
-    return data_d
+    for records, scores in clustered_dupes:
+        yield (
+            tuple(member for rep_id in records for member in members[rep_id]),
+            tuple(
+                score for rep_id, score in zip(records, scores) for _ in members[rep_id]
+            ),
+        )
 
 
 if __name__ == "__main__":
@@ -71,6 +123,31 @@ if __name__ == "__main__":
         action="count",
         help="Increase verbosity (specify multiple times for more)",
     )
+    optp.add_option(
+        "--collapse-duplicates",
+        dest="collapse_duplicates",
+        action="store_true",
+        help="Only compare one of each set of identical records, and put "
+        "identical records in the same cluster",
+    )
+    optp.add_option(
+        "--input",
+        dest="input",
+        default="csv_example_messy_input.csv",
+        help="CSV or Parquet (.parquet) file to dedupe",
+    )
+    optp.add_option(
+        "--output",
+        dest="output",
+        default="csv_example_output.csv",
+        help="CSV or Parquet (.parquet) file to write the clusters to",
+    )
+    optp.add_option(
+        "--block-cache",
+        dest="block_cache",
+        default="csv_example_block_keys.db",
+        help="SQLite file to keep block keys in between runs",
+    )
     (opts, args) = optp.parse_args()
     log_level = logging.WARNING
     if opts.verbose:
@@ -82,13 +159,14 @@ if __name__ == "__main__":
 
     # ## Setup
 
-    input_file = "csv_example_messy_input.csv"
-    output_file = "csv_example_output.csv"
+    input_file = opts.input
+    output_file = opts.output
     settings_file = "csv_example_learned_settings"
     training_file = "csv_example_training.json"
 
     print("importing data ...")
-    data_d = readData(input_file)
+    row_index = row_index_for(input_file)
+    data_d = readData(input_file, row_index)
 
     # If a settings file already exists, we'll just load that and skip training
     if os.path.exists(settings_file):
@@ -125,9 +203,12 @@ if __name__ == "__main__":
         # or not.
         # use 'y', 'n' and 'u' keys to flag duplicates
         # press 'f' when you are finished
+        #
+        # We only keep the fields dedupe compares in memory, but when we
+        # show you a record we read its whole row back from the input file.
         print("starting active labeling...")
 
-        dedupe.console_label(deduper)
+        console_label(deduper, row_index)
 
         # Using the examples we just labeled, train the deduper and learn
         # blocking predicates
@@ -148,33 +229,56 @@ if __name__ == "__main__":
     # `partition` will return sets of records that dedupe
     # believes are all referring to the same entity.
 
+    # Most of the records are the same from one run to the next, so we
+    # keep their block keys on disk, and only compute them for records
+    # that are new or have changed since the last run with these
+    # settings.
+    block_cache = BlockKeyCache(opts.block_cache, settings_file)
+
     print("clustering...")
-    clustered_dupes = deduper.partition(data_d, 0.5)
+    if opts.collapse_duplicates:
+        # Records that are identical in every field dedupe uses would
+        # all be blocked, paired and scored against each other. Instead,
+        # we dedupe one representative of each group of identical
+        # records, and then put the rest of the group in the same
+        # cluster as their representative. That forces identical
+        # records into one cluster, and clusters every representative
+        # as a single record, so the clusters, and precision and
+        # recall, come out slightly different.
+        fields = [variable.field for variable in deduper.data_model.field_variables]
+        representatives, members = collapseDuplicates(data_d, fields)
+        print(len(data_d) - len(representatives), "identical records collapsed")
+
+        clustered_dupes = list(
+            expandClusters(
+                partition(deduper, representatives, 0.5, block_cache), members
+            )
+        )
+    else:
+        clustered_dupes = partition(deduper, data_d, 0.5, block_cache)
+
+    print(
+        "block keys of %d records computed, %d from the cache"
+        % (block_cache.misses, block_cache.hits)
+    )
+    block_cache.close()
 
     print("# duplicate sets", len(clustered_dupes))
 
     # ## Writing Results
 
     # Write our original data back out to a CSV with a new column called
-    # 'Cluster ID' which indicates which records refer to each other.
+    # 'Cluster ID' which indicates which records refer to each other. The
+    # cluster of every record is kept in arrays in the order of the input
+    # file, so we can copy the input file to the output in one pass.
 
-    cluster_membership = {}
+    cluster_membership = ClusterMembership(row_index)
     for cluster_id, (records, scores) in enumerate(clustered_dupes):
         for record_id, score in zip(records, scores):
-            cluster_membership[record_id] = {
-                "Cluster ID": cluster_id,
-                "confidence_score": score,
-            }
+            cluster_membership.add(record_id, cluster_id, score)
 
-    with open(output_file, "w") as f_output, open(input_file) as f_input:
-
-        reader = csv.DictReader(f_input)
-        fieldnames = ["Cluster ID", "confidence_score"] + reader.fieldnames
-
-        writer = csv.DictWriter(f_output, fieldnames=fieldnames)
-        writer.writeheader()
+    write_results_file(
+        output_file, cluster_membership, columns=("Cluster ID", "confidence_score")
+    )
 
-        for row in reader:
-            row_id = int(row["Id"])
-            row.update(cluster_membership[row_id])
-            writer.writerow(row)
+    row_index.close()
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+"""
+This is the same dedupe as `csv_example.py`, but it doesn't keep the
+records in memory, so it can work through CSV files of millions of rows
+on a single machine, without a database server.
+
+The CSV is streamed into a local [SQLite](https://sqlite.org) file. As
+we go, we keep a random sample of the records in memory for training.
+Then we write the block keys for every record to a `blocking_map`
+table, find the candidate pairs with an indexed self-join, and look up
+the records of each pair by their rowid only when dedupe scores them.
+
+The settings and training files are shared with `csv_example.py`.
+"""
+
+import csv
+import json
+import logging
+import optparse
+import os
+import random
+import sqlite3
+
+import dedupe
+
+from csv_example import preProcess
+
+
+def loadData(con, filename, sample_size):
+    """
+    Stream our CSV file into the `records` table, keyed by the record
+    ID, and return a random sample of the records for training.
+    """
+    con.execute("DROP TABLE IF EXISTS records")
+    con.execute("CREATE TABLE records (id INTEGER PRIMARY KEY, record TEXT)")
+
+    # We keep a uniform sample of the rows with reservoir sampling, so
+    # we never need more than `sample_size` records in memory
+    sample = []
+
+    def rows(reader):
+        for i, row in enumerate(reader):
+            clean_row = {k: preProcess(v) for (k, v) in row.items()}
+            row_id = int(row["Id"])
+
+            if i < sample_size:
+                sample.append((row_id, clean_row))
+            else:
+                j = random.randint(0, i)
+                if j < sample_size:
+                    sample[j] = (row_id, clean_row)
+
+            yield row_id, json.dumps(clean_row)
+
+    with open(filename) as f:
+        reader = csv.DictReader(f)
+        con.executemany("INSERT INTO records VALUES (?, ?)", rows(reader))
+
+    con.commit()
+
+    return dict(sample)
+
+
+def records(con):
+    """
+    Stream every record out of the database as `(record_id, record)`
+    tuples
+    """
+    cur = con.execute("SELECT id, record FROM records")
+    for record_id, record in cur:
+        yield record_id, json.loads(record)
+
+
+def fieldValues(con, field):
+    cur = con.execute(
+        "SELECT DISTINCT json_extract(record, ?) FROM records", ('$."%s"' % field,)
+    )
+    for (value,) in cur:
+        yield value
+
+
+def candidatePairs(con):
+    """
+    Yield every pair of records that share a block key, once, as the
+    `((record_id, record), (record_id, record))` tuples dedupe scores
+    """
+    cur = con.execute(
+        """
+        SELECT a.id, a.record, b.id, b.record
+        FROM (SELECT DISTINCT l.record_id AS east, r.record_id AS west
+              FROM blocking_map AS l
+              INNER JOIN blocking_map AS r
+              USING (block_key)
+              WHERE l.record_id < r.record_id) ids
+        INNER JOIN records a ON ids.east = a.id
+        INNER JOIN records b ON ids.west = b.id
+        """
+    )
+    for a_id, a_record, b_id, b_record in cur:
+        yield (a_id, json.loads(a_record)), (b_id, json.loads(b_record))
+
+
+if __name__ == "__main__":
+    # ## Logging
+
+    # To enable verbose logging, run `python csv_example_sqlite.py -v`
+    optp = optparse.OptionParser()
+    optp.add_option(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="count",
+        help="Increase verbosity (specify multiple times for more)",
+    )
+    optp.add_option(
+        "--input",
+        dest="input_file",
+        default="csv_example_messy_input.csv",
+        help="CSV file to dedupe",
+    )
+    optp.add_option(
+        "--output",
+        dest="output_file",
+        default="csv_example_output.csv",
+        help="CSV file to write the clustered records to",
+    )
+    optp.add_option(
+        "--database",
+        dest="database",
+        default="csv_example.sqlite",
+        help="SQLite file to hold the records and blocking map",
+    )
+    optp.add_option(
+        "--sample-size",
+        dest="sample_size",
+        type="int",
+        default=50000,
+        help="Number of records to keep in memory for training",
+    )
+    (opts, args) = optp.parse_args()
+    log_level = logging.WARNING
+    if opts.verbose:
+        if opts.verbose == 1:
+            log_level = logging.INFO
+        elif opts.verbose >= 2:
+            log_level = logging.DEBUG
+    logging.basicConfig(level=log_level)
+
+    # ## Setup
+
+    input_file = opts.input_file
+    output_file = opts.output_file
+    settings_file = "csv_example_learned_settings"
+    training_file = "csv_example_training.json"
+
+    con = sqlite3.connect(opts.database)
+    # The database is a scratch space that we rebuild on every run, so
+    # we don't need a journal, and SQLite should sort on disk, not in
+    # memory
+    con.execute("PRAGMA journal_mode = OFF")
+    con.execute("PRAGMA synchronous = OFF")
+    con.execute("PRAGMA temp_store = FILE")
+
+    print("importing data ...")
+    sample_d = loadData(con, input_file, opts.sample_size)
+
+    # If a settings file already exists, we'll just load that and skip training
+    if os.path.exists(settings_file):
+        print("reading from", settings_file)
+        with open(settings_file, "rb") as f:
+            deduper = dedupe.StaticDedupe(f)
+    else:
+        # ## Training
+
+        # Define the fields dedupe will pay attention to
+        fields = [
+            dedupe.variables.String("Site name"),
+            dedupe.variables.String("Address"),
+            dedupe.variables.Exact("Zip", has_missing=True),
+            dedupe.variables.String("Phone", has_missing=True),
+        ]
+
+        deduper = dedupe.Dedupe(fields)
+
+        # We train on our sample of the records, not on all of them
+        if os.path.exists(training_file):
+            print("reading labeled examples from ", training_file)
+            with open(training_file, "rb") as f:
+                deduper.prepare_training(sample_d, f)
+        else:
+            deduper.prepare_training(sample_d)
+
+        print("starting active labeling...")
+
+        dedupe.console_label(deduper)
+
+        deduper.train()
+
+        with open(training_file, "w") as tf:
+            deduper.write_training(tf)
+
+        with open(settings_file, "wb") as sf:
+            deduper.write_settings(sf)
+
+        deduper.cleanup_training()
+
+    del sample_d
+
+    # ## Blocking
+
+    print("blocking...")
+
+    # If dedupe learned a Index Predicate, we have to take a pass
+    # through the data and create indices.
+    for field in deduper.fingerprinter.index_fields:
+        deduper.fingerprinter.index(fieldValues(con, field), field)
+
+    con.execute("DROP TABLE IF EXISTS blocking_map")
+    con.execute("CREATE TABLE blocking_map (block_key TEXT, record_id INTEGER)")
+
+    b_data = deduper.fingerprinter(records(con))
+    con.executemany("INSERT INTO blocking_map VALUES (?, ?)", b_data)
+
+    deduper.fingerprinter.reset_indices()
+
+    # With an index on the block keys, the self-join that finds our
+    # candidate pairs doesn't need to sort the whole blocking map
+    con.execute(
+        "CREATE INDEX blocking_map_key_idx ON blocking_map (block_key, record_id)"
+    )
+    con.commit()
+
+    # ## Clustering
+
+    # `score` writes the scores of all the pairs to a memory mapped
+    # file, so they don't need to fit in memory either.
+    print("clustering...")
+    clustered_dupes = deduper.cluster(deduper.score(candidatePairs(con)), 0.5)
+
+    con.execute("DROP TABLE IF EXISTS entity_map")
+    con.execute(
+        "CREATE TABLE entity_map "
+        "(record_id INTEGER PRIMARY KEY, cluster_id INTEGER, confidence_score REAL)"
+    )
+
+    def cluster_rows(clustered_dupes):
+        for cluster_id, (records, scores) in enumerate(clustered_dupes):
+            for record_id, score in zip(records, scores):
+                yield int(record_id), cluster_id, float(score)
+
+    con.executemany(
+        "INSERT INTO entity_map VALUES (?, ?, ?)", cluster_rows(clustered_dupes)
+    )
+    con.commit()
+
+    # ## Writing Results
+
+    # Every record that isn't in a cluster of duplicates gets a cluster
+    # of its own, numbered after the clusters dedupe found.
+    (next_cluster_id,) = con.execute(
+        "SELECT COALESCE(MAX(cluster_id) + 1, 0) FROM entity_map"
+    ).fetchone()
+
+    with open(output_file, "w") as f_output, open(input_file) as f_input:
+        reader = csv.DictReader(f_input)
+        fieldnames = ["Cluster ID", "confidence_score"] + reader.fieldnames
+
+        writer = csv.DictWriter(f_output, fieldnames=fieldnames)
+        writer.writeheader()
+
+        for row in reader:
+            row_id = int(row["Id"])
+            membership = con.execute(
+                "SELECT cluster_id, confidence_score FROM entity_map "
+                "WHERE record_id = ?",
+                (row_id,),
+            ).fetchone()
+            if membership is None:
+                membership = (next_cluster_id, 1.0)
+                next_cluster_id += 1
+            row["Cluster ID"], row["confidence_score"] = membership
+            writer.writerow(row)
+
+    print("# duplicate sets", next_cluster_id)
+
+    con.close()
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+"""
+Find a good clustering threshold for the [csv_example](csv_example.html).
+
+`csv_example.py` clusters with a threshold of 0.5. To see how precision
+and recall change with the threshold, we could run `csv_example.py`
+and `csv_evaluation.py` once per threshold, but then every run blocks
+and scores all the pairs again, and the scores don't depend on the
+threshold at all.
+
+Instead, this script blocks and scores the pairs once, using the
+settings file `csv_example.py` learned, and then only clusters again
+for every threshold. Each clustering is compared to the `True Id`
+column of `csv_example_input_with_true_ids.csv`. We print the
+precision, recall and F1 of every threshold, and the threshold with the
+best F1.
+
+    python csv_threshold_sweep.py --thresholds 0.3,0.4,0.5,0.6,0.7
+"""
+
+import itertools
+import logging
+import optparse
+import os
+
+import dedupe
+from dedupe.core import BlockingError
+
+from csv_evaluation import dupePairs, precisionRecall
+from csv_example import readData
+
+
+def foundPairs(clusters):
+    """
+    All the pairs of record IDs that are in the same cluster, as
+    strings, like `csv_evaluation.dupePairs` returns them
+    """
+    found = set()
+    for record_ids, _ in clusters:
+        for pair in itertools.combinations(record_ids, 2):
+            found.add(frozenset(str(record_id) for record_id in pair))
+    return found
+
+
+def f1(precision, recall):
+    if precision + recall == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+
+if __name__ == "__main__":
+    optp = optparse.OptionParser()
+    optp.add_option(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="count",
+        help="Increase verbosity (specify multiple times for more)",
+    )
+    optp.add_option(
+        "--thresholds",
+        dest="thresholds",
+        default="0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9",
+        help="Comma separated thresholds to cluster at",
+    )
+    (opts, args) = optp.parse_args()
+    log_level = logging.WARNING
+    if opts.verbose:
+        if opts.verbose == 1:
+            log_level = logging.INFO
+        elif opts.verbose >= 2:
+            log_level = logging.DEBUG
+    logging.basicConfig(level=log_level)
+
+    thresholds = [float(threshold) for threshold in opts.thresholds.split(",")]
+
+    input_file = "csv_example_messy_input.csv"
+    manual_clusters = "csv_example_input_with_true_ids.csv"
+    settings_file = "csv_example_learned_settings"
+
+    if not os.path.exists(settings_file):
+        raise SystemExit(
+            "%s not found, run csv_example.py to learn the settings first"
+            % settings_file
+        )
+
+    print("importing data ...")
+    data_d = readData(input_file)
+
+    with open(settings_file, "rb") as f:
+        deduper = dedupe.StaticDedupe(f)
+
+    # ## Scoring
+
+    # Blocking and scoring only happen once. The scores are kept in a
+    # memory mapped file that we can cluster as many times as we like.
+    print("scoring...")
+    try:
+        scores = deduper.score(deduper.pairs(data_d))
+    except BlockingError:
+        raise SystemExit("no candidate pairs, nothing to cluster")
+    print("# scored pairs", len(scores))
+
+    true_dupes = dupePairs(manual_clusters, "True Id")
+
+    # ## Clustering at every threshold
+
+    print()
+    print("%9s %8s %9s %9s %9s" % ("threshold", "found", "precision", "recall", "F1"))
+
+    best = None
+    for threshold in thresholds:
+        # dedupe can't cluster an empty array of scores, which is what
+        # we get if no pair scored above 0
+        if len(scores):
+            found_dupes = foundPairs(deduper.cluster(scores, threshold))
+        else:
+            found_dupes = set()
+        precision, recall = precisionRecall(found_dupes, true_dupes)
+        f_score = f1(precision, recall)
+
+        print(
+            "%9.2f %8d %9.3f %9.3f %9.3f"
+            % (threshold, len(found_dupes), precision, recall, f_score)
+        )
+
+        if best is None or f_score > best[1]:
+            best = (threshold, f_score)
+
+    print()
+    print("best threshold %.2f, F1 %.3f" % best)
+
+    scores_file = getattr(scores, "filename", None)
+    del scores
+    if scores_file:
+        os.remove(scores_file)
@@ -3,60 +3,73 @@
 This code demonstrates how to use some extended dedupe variables
 """
 
-import csv
 import logging
 import optparse
 import os
-import re
+import sys
 
 import addressvariable
 import dedupe
 import namevariable
-import unidecode
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.csvio import RowIndex, read_csv
+from shared.labeling import console_label
+from shared.normalize import Normalizer
+from shared.records import RecordStore
+from shared.results import ClusterMembership, write_results
 
-def preProcess(column):
-    """
-    Do a little bit of data cleaning with the help of Unidecode and Regex.
-    Things like casing, extra spaces, quotes and new lines can be ignored.
-    """
-    column = unidecode.unidecode(column)
-    column = re.sub("  +", " ", column)
-    column = re.sub("\n", " ", column)
-    column = column.strip().strip('"').strip("'").lower().strip()
-    return column
+
+# Do a little bit of data cleaning with the help of Unidecode and Regex.
+# Things like casing, extra spaces, quotes and new lines can be ignored.
+preProcess = Normalizer([("  +", " "), ("\n", " ")], null_empty=False)
+
+
+# The fields our data model compares. These are the only columns we
+# keep in memory.
+MODEL_FIELDS = (
+    "name",
+    "address",
+    "City",
+    "State",
+    "Zip",
+    "Phone",
+    "RedactionRequested",
+)
+
+
+def cleanRow(row):
+    clean_row = {k: preProcess(v) for (k, v) in row.items()}
+    clean_row["name"] = " ".join([clean_row["FirstName"], clean_row["LastName"]])
+    if not clean_row["name"]:
+        clean_row["name"] = None
+    clean_row["address"] = " ".join([clean_row["Address1"], clean_row["Address2"]])
+    if not clean_row["address"]:
+        clean_row["address"] = None
+
+    for k, v in clean_row.items():
+        if not v:
+            clean_row[k] = None
+
+    return clean_row
 
 
-def readData(filename):
+def readData(filename, row_index=None):
     """
     Read in our data from a CSV file and create a dictionary of records,
     where the key is a unique record ID and each value is dict
-    """
-
-    data_d = {}
-    with open(filename) as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            clean_row = {k: preProcess(v) for (k, v) in row.items()}
-            clean_row["name"] = " ".join(
-                [clean_row["FirstName"], clean_row["LastName"]]
-            )
-            if not clean_row["name"]:
-                clean_row["name"] = None
-            clean_row["address"] = " ".join(
-                [clean_row["Address1"], clean_row["Address2"]]
-            )
-            if not clean_row["address"]:
-                clean_row["address"] = None
-            row_id = int(row["ID"])
 
-            for k, v in clean_row.items():
-                if not v:
-                    clean_row[k] = None
-
-            data_d[row_id] = clean_row
+    If there is a `row_index`, it learns where each record's row is in
+    the file, so we can read the whole row again when we need it.
+    """
 
-    return data_d
+    return read_csv(
+        filename,
+        cleanRow,
+        id_column="ID",
+        data_d=RecordStore(MODEL_FIELDS),
+        row_index=row_index,
+    )
 
 
 if __name__ == "__main__":
@@ -91,7 +104,8 @@ if __name__ == "__main__":
     training_file = "officers_training.json"
 
     print("importing data ...")
-    data_d = readData(input_file)
+    row_index = RowIndex(input_file)
+    data_d = readData(input_file, row_index)
 
     # ## Training
 
@@ -138,7 +152,7 @@ if __name__ == "__main__":
         # press 'f' when you are finished
         print("starting active labeling...")
 
-        dedupe.console_label(deduper)
+        console_label(deduper, row_index)
 
         deduper.train()
 
@@ -167,27 +181,15 @@ if __name__ == "__main__":
     # Write our original data back out to a CSV with a new column called
     # 'Cluster ID' which indicates which records refer to each other.
 
-    cluster_membership = {}
+    cluster_membership = ClusterMembership(row_index)
     for cluster_id, cluster in enumerate(clustered_dupes):
         id_set, scores = cluster
         for record_id, score in zip(id_set, scores):
-            cluster_membership[record_id] = {
-                "cluster id": cluster_id,
-                "confidence": score,
-            }
+            cluster_membership.add(record_id, cluster_id, score)
 
     with open(output_file, "w") as f_output:
-        writer = csv.writer(f_output)
-
-        with open(input_file) as f_input:
-
-            reader = csv.DictReader(f_input)
-            fieldnames = ["cluster id", "confidence"] + reader.fieldnames
-
-            writer = csv.DictWriter(f_output, fieldnames=fieldnames)
-            writer.writeheader()
+        write_results(
+            f_output, cluster_membership, columns=("cluster id", "confidence")
+        )
 
-            for row in reader:
-                row_id = int(row["ID"])
-                row.update(cluster_membership[row_id])
-                writer.writerow(row)
+    row_index.close()
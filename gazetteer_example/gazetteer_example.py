@@ -7,53 +7,55 @@ canonical set.
 
 """
 
-import csv
 import logging
 import optparse
 import os
-import re
+import sys
 
 import dedupe
-from unidecode import unidecode
 
-
-def preProcess(column):
-    """
-    Do a little bit of data cleaning with the help of Unidecode and Regex.
-    Things like casing, extra spaces, quotes and new lines can be ignored.
-    """
-
-    column = unidecode(column)
-    column = re.sub("\n", " ", column)
-    column = re.sub("-", "", column)
-    column = re.sub("/", " ", column)
-    column = re.sub("'", "", column)
-    column = re.sub(",", "", column)
-    column = re.sub(":", " ", column)
-    column = re.sub(" +", " ", column)
-    column = column.strip().strip('"').strip("'").lower().strip()
-    if not column:
-        column = None
-    return column
-
-
-def readData(filename):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared import gazetteer_index
+from shared.corpus import CorpusCache
+from shared.csvio import RowIndex, read_csv
+from shared.normalize import Normalizer
+from shared.results import ClusterMembership, write_results
+from shared.topk import TopKCandidates
+
+
+# Do a little bit of data cleaning with the help of Unidecode and Regex.
+# Things like casing, extra spaces, quotes and new lines can be ignored.
+# If data is missing, indicate that by setting the value to `None`.
+preProcess = Normalizer(
+    [
+        ("\n", " "),
+        ("-", ""),
+        ("/", " "),
+        ("'", ""),
+        (",", ""),
+        (":", " "),
+        (" +", " "),
+    ]
+)
+
+
+def cleanRow(row):
+    clean_row = {k: preProcess(v) for (k, v) in row.items()}
+    if clean_row["price"]:
+        clean_row["price"] = float(clean_row["price"][1:])
+    return clean_row
+
+
+def readData(filename, row_index=None):
     """
     Read in our data from a CSV file and create a dictionary of records,
     where the key is a unique record ID.
-    """
-
-    data_d = {}
 
-    with open(filename) as f:
-        reader = csv.DictReader(f)
-        for i, row in enumerate(reader):
-            clean_row = {k: preProcess(v) for (k, v) in row.items()}
-            if clean_row["price"]:
-                clean_row["price"] = float(clean_row["price"][1:])
-            data_d[filename + str(i)] = dict(clean_row)
+    If there is a `row_index`, it learns where each record's row is in
+    the file.
+    """
 
-    return data_d
+    return read_csv(filename, cleanRow, id_prefix=filename, row_index=row_index)
 
 
 if __name__ == "__main__":
@@ -71,7 +73,22 @@ if __name__ == "__main__":
         action="count",
         help="Increase verbosity (specify multiple times for more)",
     )
+    optp.add_option(
+        "--index-dir",
+        dest="index_dir",
+        help="Keep the index of the canonical records in this directory "
+        "between runs",
+    )
+    optp.add_option(
+        "--top-k",
+        dest="top_k",
+        type="int",
+        help="Instead of blocking, compare every messy record with the K "
+        "canonical records most similar to it by TF-IDF",
+    )
     (opts, args) = optp.parse_args()
+    if opts.top_k and opts.index_dir:
+        optp.error("--index-dir doesn't work with --top-k")
     log_level = logging.WARNING
     if opts.verbose:
         if opts.verbose == 1:
@@ -85,15 +102,18 @@ if __name__ == "__main__":
     output_file = "gazetteer_output.csv"
     settings_file = "gazetteer_learned_settings"
     training_file = "gazetteer_training.json"
+    corpus_file = "gazetteer_corpus.db"
 
     canon_file = os.path.join("data", "AbtBuy_Buy.csv")
     messy_file = os.path.join("data", "AbtBuy_Abt.csv")
 
     print("importing data ...")
-    messy = readData(messy_file)
+    messy_index = RowIndex(messy_file)
+    messy = readData(messy_file, messy_index)
     print(f"N data 1 records: {len(messy)}")
 
-    canonical = readData(canon_file)
+    canon_index = RowIndex(canon_file)
+    canonical = readData(canon_file, canon_index)
     print(f"N data 2 records: {len(canonical)}")
 
     def descriptions():
@@ -107,15 +127,23 @@ if __name__ == "__main__":
             gazetteer = dedupe.StaticGazetteer(sf)
 
     else:
-        # Define the fields the gazetteer will pay attention to
+        # Define the fields the gazetteer will pay attention to. The document
+        # frequencies of the descriptions are kept in `corpus_file`
+        # between runs, and only counted again for new records.
+        corpus_cache = CorpusCache(corpus_file)
         fields = [
             dedupe.variables.String("title"),
             dedupe.variables.Text("title"),
-            dedupe.variables.Text(
-                "description", corpus=descriptions(), has_missing=True
+            corpus_cache.text_variable(
+                "description", "descriptions", descriptions, has_missing=True
             ),
             dedupe.variables.Price("price", has_missing=True),
         ]
+        print(
+            "document frequencies of %d documents counted, %d from the cache"
+            % (corpus_cache.counted, corpus_cache.cached)
+        )
+        corpus_cache.close()
 
         # Create a new gazetteer object and pass our data model to it.
         gazetteer = dedupe.Gazetteer(fields)
@@ -154,51 +182,45 @@ if __name__ == "__main__":
 
         gazetteer.cleanup_training()
 
-    gazetteer.index(canonical)
+    # ## Indexing
+
+    # With `--index-dir`, the index of the canonical records is saved
+    # the first time, and later runs attach to it instead of indexing
+    # the records again, as long as the settings and the canonical file
+    # haven't changed.
+    if opts.top_k:
+        # Instead of the learned blocking predicates, `search` compares
+        # every messy record with the `top_k` canonical records most
+        # similar to it, so there are always the same number of pairs
+        # to score.
+        candidates = TopKCandidates(("title", "description"), k=opts.top_k)
+        candidates.index(canonical)
+        gazetteer.blocks = candidates.blocks
+    elif opts.index_dir:
+        if gazetteer_index.index(
+            gazetteer, canonical, opts.index_dir, settings_file, canon_file
+        ):
+            print("attached to the index in", opts.index_dir)
+        else:
+            print("indexed the canonical records into", opts.index_dir)
+    else:
+        gazetteer.index(canonical)
 
     results = gazetteer.search(messy, n_matches=2, generator=True)
 
-    cluster_membership = {}
+    cluster_membership = ClusterMembership(messy_index, canon_index)
     cluster_id = 0
 
     for cluster_id, (messy_id, matches) in enumerate(results):
         for canon_id, score in matches:
-            cluster_membership[messy_id] = {
-                "Cluster ID": cluster_id,
-                "Link Score": score,
-            }
-            cluster_membership[canon_id] = {
-                "Cluster ID": cluster_id,
-                "Link Score": score,
-            }
+            cluster_membership.add(messy_id, cluster_id, score)
+            cluster_membership.add(canon_id, cluster_id, score)
             cluster_id += 1
 
     with open(output_file, "w") as f:
-
-        header_unwritten = True
-
-        for fileno, filename in enumerate((messy_file, canon_file)):
-            with open(filename) as f_input:
-                reader = csv.DictReader(f_input)
-
-                if header_unwritten:
-
-                    fieldnames = [
-                        "Cluster ID",
-                        "Link Score",
-                        "source file",
-                    ] + reader.fieldnames
-
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
-
-                    header_unwritten = False
-
-                for row_id, row in enumerate(reader):
-
-                    record_id = filename + str(row_id)
-                    cluster_details = cluster_membership.get(record_id, {})
-                    row["source file"] = fileno
-                    row.update(cluster_details)
-
-                    writer.writerow(row)
+        write_results(
+            f,
+            cluster_membership,
+            columns=("Cluster ID", "Link Score"),
+            source_column="source file",
+        )
@@ -0,0 +1,493 @@
+#!/usr/bin/python
+"""
+A matching service for the [gazetteer_example](gazetteer_example.html).
+
+`gazetteer_example.py` loads the settings, indexes the canonical records
+and searches once, so every run pays for loading the model and building
+the index. This server does that once, when it starts, and then matches
+records against the canonical records as they come in over HTTP:
+
+    python gazetteer_server.py --port 8000
+
+    curl -d '{"record": {"title": "linksys etherfast 8 port switch"}}' \\
+        http://127.0.0.1:8000/match
+
+`POST /match` takes a JSON object with either a `record` or a list of
+`records`, with the same fields as `AbtBuy_Abt.csv`, and an optional
+`n_matches`. It answers with the best `n_matches` canonical records for
+every record, best first. `GET /stats` reports the latency percentiles
+and throughput so far.
+
+`POST /canonical` adds, updates and removes canonical records, without
+indexing the others again:
+
+    curl -d '{"add": {"new1": {"title": "weber q 300 gas grill"}},
+              "remove": ["data/AbtBuy_Buy.csv0"]}' \\
+        http://127.0.0.1:8000/canonical
+
+Searching has a cost for every call, whatever the number of records, so
+the server doesn't search every request on its own. Requests wait in a
+queue, and a single thread takes up to `--max-batch` records at a time,
+waiting at most `--max-wait` milliseconds for more to arrive, and
+searches them together.
+"""
+
+import collections
+import http.server
+import itertools
+import json
+import logging
+import optparse
+import os
+import queue
+import sys
+import threading
+import time
+
+import dedupe
+
+from gazetteer_example import cleanRow, readData
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared import gazetteer_index
+
+FIELDS = ("title", "description", "price")
+
+MAX_BATCH = 64
+MAX_WAIT = 5  # milliseconds
+
+
+def percentile(values, q):
+    """
+    The `q` quantile of a sorted list of values, or `None` if it's empty
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class LatencyStats:
+    """
+    Latencies of the last `window` requests, and counts of everything
+    matched since the server started
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.started = time.monotonic()
+        self.requests = 0
+        self.records = 0
+        self.batches = 0
+
+    def add_batch(self, latencies, n_records):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.requests += len(latencies)
+            self.records += n_records
+            self.batches += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            elapsed = time.monotonic() - self.started
+            summary = {
+                "requests": self.requests,
+                "records": self.records,
+                "batches": self.batches,
+                "records_per_batch": self.records / max(self.batches, 1),
+                "records_per_second": self.records / elapsed,
+            }
+        for name, q in (("p50_ms", 0.5), ("p99_ms", 0.99)):
+            latency = percentile(latencies, q)
+            summary[name] = None if latency is None else latency * 1000
+        return summary
+
+
+class Request:
+    def __init__(self, records, n_matches):
+        self.records = records
+        self.n_matches = n_matches
+        self.received = time.monotonic()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class Task:
+    """
+    A function to call on the batcher's thread, between two batches
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.function()
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+
+class MicroBatcher:
+    """
+    Search the records of concurrent requests together, in batches of
+    up to `max_batch` records. The first request of a batch waits at
+    most `max_wait` seconds for others to join it.
+
+    Only the batcher's thread uses `gazetteer` and `canonical`, its
+    canonical records by id.
+    """
+
+    def __init__(
+        self, gazetteer, canonical, threshold, max_batch=MAX_BATCH, max_wait=MAX_WAIT
+    ):
+        self.gazetteer = gazetteer
+        self.canonical = canonical
+        self.threshold = threshold
+        self.max_batch = max_batch
+        self.max_wait = max_wait / 1000
+        self.requests = queue.Queue()
+        self.stats = LatencyStats()
+        self.record_ids = itertools.count()
+
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def match(self, records, n_matches):
+        """
+        For every record, a list of `(canonical_id, score,
+        canonical_record)` tuples, best first. Blocks until the batch
+        with the records has been searched.
+        """
+        request = Request(records, n_matches)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def call(self, function):
+        """
+        Call `function` on the batcher's thread, so it can change the
+        gazetteer without a search seeing it half done
+        """
+        task = Task(function)
+        self.requests.put(task)
+        task.done.wait()
+        if task.error is not None:
+            raise task.error
+        return task.result
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if isinstance(request, Task):
+                request.run()
+                continue
+
+            batch = [request]
+            n_records = len(request.records)
+            task = None
+            deadline = time.monotonic() + self.max_wait
+            while n_records < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if isinstance(request, Task):
+                    task = request
+                    break
+                batch.append(request)
+                n_records += len(request.records)
+
+            self.search(batch)
+            if task is not None:
+                task.run()
+
+    def search(self, batch):
+        # every record of the batch gets an id of its own, whatever
+        # request it came from. dedupe wants them to be of the same type
+        # as the ids of the canonical records, which are strings.
+        data = {}
+        request_ids = []
+        for request in batch:
+            ids = []
+            for record in request.records:
+                record_id = "request%d" % next(self.record_ids)
+                data[record_id] = record
+                ids.append(record_id)
+            request_ids.append(ids)
+
+        try:
+            results = dict(
+                self.gazetteer.search(
+                    data,
+                    threshold=self.threshold,
+                    n_matches=max(request.n_matches for request in batch),
+                )
+            )
+        except Exception as e:
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+
+        # the canonical records are copied here, before a task can
+        # change or remove them
+        now = time.monotonic()
+        for request, ids in zip(batch, request_ids):
+            request.results = [
+                [
+                    (canon_id, float(score), dict(self.canonical[canon_id]))
+                    for canon_id, score in results[record_id][: request.n_matches]
+                ]
+                for record_id in ids
+            ]
+            request.done.set()
+
+        self.stats.add_batch([now - request.received for request in batch], len(data))
+
+
+def clean_record(record):
+    return cleanRow({field: record.get(field) or "" for field in FIELDS})
+
+
+class MatchHandler(http.server.BaseHTTPRequestHandler):
+    # set by `serve`
+    batcher = None
+    documents = None
+    n_matches = 1
+
+    def do_POST(self):
+        if self.path == "/canonical":
+            self.change_canonical()
+            return
+        if self.path != "/match":
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length))
+            if "records" in body:
+                records = body["records"]
+            else:
+                records = [body["record"]]
+            if not records:
+                raise ValueError("no records to match")
+            records = [clean_record(record) for record in records]
+            n_matches = int(body.get("n_matches", self.n_matches))
+            if n_matches < 1:
+                raise ValueError("n_matches must be at least 1")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_error(400, str(e))
+            return
+
+        try:
+            results = self.batcher.match(records, n_matches)
+        except Exception as e:
+            logging.exception("search failed")
+            self.send_error(500, str(e))
+            return
+
+        self.send_json(
+            {
+                "matches": [
+                    [
+                        {"id": canon_id, "score": score, "record": record}
+                        for canon_id, score, record in matches
+                    ]
+                    for matches in results
+                ]
+            }
+        )
+
+    def change_canonical(self):
+        """
+        Add, update or remove canonical records, without indexing the
+        others again. The body is a JSON object with `add`, an object of
+        records by id, and `remove`, a list of ids. Records in `add`
+        that are already indexed are updated.
+        """
+        if self.documents is None:
+            self.send_error(409, "the canonical records are in a saved index")
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length))
+            added = {
+                record_id: clean_record(record)
+                for record_id, record in body.get("add", {}).items()
+            }
+            removed = list(body.get("remove", []))
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_error(400, str(e))
+            return
+
+        def change():
+            canonical = self.batcher.canonical
+            missing = [r for r in removed if r not in canonical]
+            if missing:
+                return missing, None
+            if removed:
+                gazetteer_index.remove(self.batcher.gazetteer, self.documents, removed)
+            if added:
+                gazetteer_index.add(self.batcher.gazetteer, self.documents, added)
+            return [], len(canonical)
+
+        try:
+            missing, n_canonical = self.batcher.call(change)
+        except Exception as e:
+            logging.exception("changing the canonical records failed")
+            self.send_error(500, str(e))
+            return
+
+        if missing:
+            self.send_error(404, "not indexed: %s" % ", ".join(map(str, missing)))
+            return
+
+        self.send_json(
+            {"added": len(added), "removed": len(removed), "canonical": n_canonical}
+        )
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.send_error(404)
+            return
+        self.send_json(self.batcher.stats.summary())
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def serve(gazetteer, canonical, documents, opts):
+    MatchHandler.batcher = MicroBatcher(
+        gazetteer,
+        canonical,
+        opts.threshold,
+        max_batch=opts.max_batch,
+        max_wait=opts.max_wait,
+    )
+    MatchHandler.documents = documents
+    MatchHandler.n_matches = opts.n_matches
+
+    server = http.server.ThreadingHTTPServer((opts.host, opts.port), MatchHandler)
+    print("serving on http://%s:%d" % (opts.host, opts.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(MatchHandler.batcher.stats.summary(), indent=2))
+
+
+if __name__ == "__main__":
+    optp = optparse.OptionParser()
+    optp.add_option(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="count",
+        help="Increase verbosity (specify multiple times for more)",
+    )
+    optp.add_option(
+        "--index-dir",
+        dest="index_dir",
+        help="Attach to the index of the canonical records in this directory, "
+        "or save it there",
+    )
+    optp.add_option("--host", dest="host", default="127.0.0.1")
+    optp.add_option("--port", dest="port", type="int", default=8000)
+    optp.add_option(
+        "--threshold",
+        dest="threshold",
+        type="float",
+        default=0.0,
+        help="Only return canonical records that score above this",
+    )
+    optp.add_option(
+        "--n-matches",
+        dest="n_matches",
+        type="int",
+        default=1,
+        help="Canonical records to return for every record, unless asked",
+    )
+    optp.add_option(
+        "--max-batch",
+        dest="max_batch",
+        type="int",
+        default=MAX_BATCH,
+        help="Search up to this many records at a time",
+    )
+    optp.add_option(
+        "--max-wait",
+        dest="max_wait",
+        type="float",
+        default=MAX_WAIT,
+        help="Milliseconds to wait for more records to search together",
+    )
+    (opts, args) = optp.parse_args()
+    if opts.n_matches < 1:
+        optp.error("--n-matches must be at least 1")
+    log_level = logging.WARNING
+    if opts.verbose:
+        if opts.verbose == 1:
+            log_level = logging.INFO
+        elif opts.verbose >= 2:
+            log_level = logging.DEBUG
+    logging.getLogger().setLevel(log_level)
+
+    settings_file = "gazetteer_learned_settings"
+    canon_file = os.path.join("data", "AbtBuy_Buy.csv")
+
+    if not os.path.exists(settings_file):
+        raise SystemExit(
+            "%s not found, run gazetteer_example.py to learn the settings first"
+            % settings_file
+        )
+
+    start = time.perf_counter()
+
+    # One process: forking workers for every small batch would cost
+    # more than it saves
+    with open(settings_file, "rb") as sf:
+        gazetteer = dedupe.StaticGazetteer(sf, num_cores=1)
+
+    # An index saved by an earlier run spares us reading and indexing
+    # the canonical records
+    if opts.index_dir and gazetteer_index.attach(
+        gazetteer, opts.index_dir, settings_file, canon_file
+    ):
+        print("attached to the index in %s" % opts.index_dir)
+        documents = None
+    else:
+        gazetteer.index(readData(canon_file))
+        if opts.index_dir:
+            gazetteer_index.save(gazetteer, opts.index_dir, settings_file, canon_file)
+        documents = gazetteer_index.document_counts(gazetteer)
+
+    canonical = gazetteer.indexed_data
+    print(
+        "%d canonical records ready in %.2f seconds"
+        % (len(canonical), time.perf_counter() - start)
+    )
+
+    serve(gazetteer, canonical, documents, opts)
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+"""
+Send the records of `AbtBuy_Abt.csv` to a running
+[gazetteer_server](gazetteer_server.html), one record per request, from
+several threads at once, and report the latency and throughput the
+clients saw, and the server's own `/stats`.
+
+    python gazetteer_server.py &
+    python gazetteer_server_benchmark.py --concurrency 8
+"""
+
+import concurrent.futures
+import csv
+import json
+import optparse
+import os
+import time
+import urllib.request
+
+from gazetteer_server import percentile
+
+
+def post(url, record):
+    body = json.dumps({"record": record}).encode("utf-8")
+    request = urllib.request.Request(
+        url, data=body, headers={"Content-Type": "application/json"}
+    )
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        json.load(response)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    optp = optparse.OptionParser()
+    optp.add_option("--url", dest="url", default="http://127.0.0.1:8000")
+    optp.add_option(
+        "--concurrency",
+        dest="concurrency",
+        type="int",
+        default=8,
+        help="Requests to have in flight at once",
+    )
+    optp.add_option(
+        "--requests",
+        dest="requests",
+        type="int",
+        help="Send only this many records",
+    )
+    (opts, args) = optp.parse_args()
+
+    with open(os.path.join("data", "AbtBuy_Abt.csv")) as f:
+        records = list(csv.DictReader(f))
+    if opts.requests:
+        records = records[: opts.requests]
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(opts.concurrency) as executor:
+        latencies = list(
+            executor.map(lambda record: post(opts.url + "/match", record), records)
+        )
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print("requests      %d" % len(latencies))
+    print("concurrency   %d" % opts.concurrency)
+    print("p50           %.1f ms" % (percentile(latencies, 0.5) * 1000))
+    print("p99           %.1f ms" % (percentile(latencies, 0.99) * 1000))
+    print("throughput    %.0f requests/second" % (len(latencies) / elapsed))
+
+    with urllib.request.urlopen(opts.url + "/stats") as response:
+        print("server stats  %s" % json.dumps(json.load(response)))
@@ -5,49 +5,68 @@ authors and demonstrates the Set and LatLong data types.
 
 """
 
-import csv
+import functools
 import logging
 import optparse
 import os
+import random
+import sys
 
 import dedupe
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.arrowio import read_records, row_index_for, write_results_file
+from shared.blockcache import BlockKeyCache, partition
+from shared.corpus import CorpusCache
+from shared.labeling import console_label
+from shared.records import RecordStore
+from shared.results import ClusterMembership
+from shared import tuning
 
-def readData(filename, set_delim="**"):
+
+# The fields our data model compares. These are the only columns we
+# keep in memory.
+MODEL_FIELDS = ("Name", "LatLong", "Class", "Coauthor")
+
+
+def cleanRow(row, set_delim="**"):
+    row = {k: v.lower() for k, v in row.items()}
+    if row["Lat"] == row["Lng"] == "0.0":
+        row["LatLong"] = None
+    else:
+        row["LatLong"] = (float(row["Lat"]), float(row["Lng"]))
+    row["Class"] = (
+        tuple(sorted(row["Class"].split(set_delim))) if row["Class"] else None
+    )
+    row["Coauthor"] = tuple(
+        sorted(
+            [author for author in row["Coauthor"].split(set_delim) if author != "none"]
+        )
+    )
+    if row["Name"] == "":
+        row["Name"] = None
+
+    return row
+
+
+def readData(filename, set_delim="**", row_index=None):
     """
     Remap columns for the following cases:
     - Lat and Long are mapped into a single LatLong tuple
     - Class and Coauthor are stored as delimited strings but mapped into
       tuples
+
+    The file can be a CSV or a Parquet file. If there is a `row_index`,
+    it learns where each record's row is in the file, so we can read the
+    whole row again when we need it.
     """
 
-    data_d = {}
-    with open(filename) as f:
-        reader = csv.DictReader(f)
-        for idx, row in enumerate(reader):
-            row = {k: v.lower() for k, v in row.items()}
-            if row["Lat"] == row["Lng"] == "0.0":
-                row["LatLong"] = None
-            else:
-                row["LatLong"] = (float(row["Lat"]), float(row["Lng"]))
-            row["Class"] = (
-                tuple(sorted(row["Class"].split(set_delim))) if row["Class"] else None
-            )
-            row["Coauthor"] = tuple(
-                sorted(
-                    [
-                        author
-                        for author in row["Coauthor"].split(set_delim)
-                        if author != "none"
-                    ]
-                )
-            )
-            if row["Name"] == "":
-                row["Name"] = None
-
-            data_d[idx] = row
-
-    return data_d
+    return read_records(
+        filename,
+        functools.partial(cleanRow, set_delim=set_delim),
+        data_d=RecordStore(MODEL_FIELDS),
+        row_index=row_index,
+    )
 
 
 # These generators will give us the corpora setting up the Set
@@ -83,6 +102,50 @@ if __name__ == "__main__":
         action="count",
         help="Increase verbosity (specify multiple times for more)",
     )
+    optp.add_option(
+        "--input",
+        dest="input",
+        default="patstat_input.csv",
+        help="CSV or Parquet (.parquet) file to dedupe",
+    )
+    optp.add_option(
+        "--output",
+        dest="output",
+        default="patstat_output.csv",
+        help="CSV or Parquet (.parquet) file to write the clusters to",
+    )
+    optp.add_option(
+        "--block-cache",
+        dest="block_cache",
+        default="patstat_block_keys.db",
+        help="SQLite file to keep block keys in between runs",
+    )
+    optp.add_option(
+        "--corpus-cache",
+        dest="corpus_cache",
+        default="patstat_corpus.db",
+        help="SQLite file to keep the document frequencies of the corpora "
+        "in between runs",
+    )
+    optp.add_option(
+        "--calibrate",
+        dest="calibrate",
+        action="store_true",
+        help="Time scoring with different numbers of cores, save the "
+        "fastest to the profile and exit",
+    )
+    optp.add_option(
+        "--profile",
+        dest="profile",
+        default="patstat_profile.json",
+        help="Profile with the number of cores to use",
+    )
+    optp.add_option(
+        "--max-memory",
+        dest="max_memory",
+        help="Memory scoring may use, like 4G, when calibrating. Defaults "
+        "to the memory of the machine",
+    )
     (opts, args) = optp.parse_args()
     log_level = logging.WARNING
 
@@ -93,38 +156,64 @@ if __name__ == "__main__":
             log_level = logging.DEBUG
     logging.getLogger().setLevel(log_level)
 
-    input_file = "patstat_input.csv"
-    output_file = "patstat_output.csv"
+    input_file = opts.input
+    output_file = opts.output
     settings_file = "patstat_settings.json"
     training_file = "patstat_training.json"
 
+    # The number of cores that scores fastest depends on the machine. A
+    # run with `--calibrate` finds it and saves it to a profile.
+    profile = tuning.load_profile(opts.profile)
+    num_cores = profile.get("num_cores", 2)
+
     print("importing data ...")
-    data_d = readData(input_file)
+    row_index = row_index_for(input_file)
+    data_d = readData(input_file, row_index=row_index)
 
     # ## Training
 
     if os.path.exists(settings_file):
         print("reading from", settings_file)
         with open(settings_file, "rb") as sf:
-            deduper = dedupe.StaticDedupe(sf, num_cores=2)
+            deduper = dedupe.StaticDedupe(sf, num_cores=num_cores)
 
     else:
-        # Define the fields dedupe will pay attention to
+        # Define the fields dedupe will pay attention to. The document
+        # frequencies of the corpora are kept in the corpus cache between
+        # runs, and only counted again for new records.
+        corpus_cache = CorpusCache(opts.corpus_cache)
         fields = [
             dedupe.variables.String("Name", name="name_string", has_missing=True),
             dedupe.variables.LatLong("LatLong", has_missing=True),
-            dedupe.variables.Set("Class", corpus=classes(data_d), has_missing=True),
-            dedupe.variables.Set(
-                "Coauthor", corpus=coauthors(data_d), has_missing=True
+            corpus_cache.set_variable(
+                "Class",
+                "classes",
+                functools.partial(classes, data_d),
+                has_missing=True,
             ),
-            dedupe.variables.Text(
-                "Name", name="name_text", corpus=names(data_d), has_missing=True
+            corpus_cache.set_variable(
+                "Coauthor",
+                "coauthors",
+                functools.partial(coauthors, data_d),
+                has_missing=True,
+            ),
+            corpus_cache.text_variable(
+                "Name",
+                "names",
+                functools.partial(names, data_d),
+                name="name_text",
+                has_missing=True,
             ),
             dedupe.variables.Interaction("name_string", "name_text"),
         ]
+        print(
+            "document frequencies of %d documents counted, %d from the cache"
+            % (corpus_cache.counted, corpus_cache.cached)
+        )
+        corpus_cache.close()
 
         # Create a new deduper object and pass our data model to it.
-        deduper = dedupe.Dedupe(fields, num_cores=2)
+        deduper = dedupe.Dedupe(fields, num_cores=num_cores)
 
         # If we have training data saved from a previous run of dedupe,
         # look for it an load it in.
@@ -144,7 +233,7 @@ if __name__ == "__main__":
         # use 'y', 'n' and 'u' keys to flag duplicates
         # press 'f' when you are finished
         print("starting active labeling...")
-        dedupe.console_label(deduper)
+        console_label(deduper, row_index)
 
         deduper.train()
 
@@ -158,7 +247,38 @@ if __name__ == "__main__":
         with open(settings_file, "wb") as sf:
             deduper.write_settings(sf)
 
-    clustered_dupes = deduper.partition(data_d, 0.5)
+    if opts.calibrate:
+        # Scoring takes about as long for any pair of records, so we
+        # time it on random pairs
+        rng = random.Random(0)
+        record_ids = list(data_d)
+        record_pairs = []
+        for _ in range(20000):
+            a, b = sorted(rng.sample(record_ids, 2))
+            record_pairs.append(((a, data_d[a]), (b, data_d[b])))
+
+        if opts.max_memory:
+            max_memory = tuning.parse_size(opts.max_memory)
+        else:
+            max_memory = tuning.total_memory()
+
+        num_cores, results = tuning.calibrate_cores(
+            deduper, record_pairs, max_memory=max_memory
+        )
+        tuning.print_results("num_cores", results, "pairs/s")
+        tuning.save_profile(opts.profile, {"num_cores": num_cores})
+        print("saved num_cores", num_cores, "to", opts.profile)
+        sys.exit()
+
+    # Block keys of records that haven't changed since the last run with
+    # these settings come from the cache
+    block_cache = BlockKeyCache(opts.block_cache, settings_file)
+    clustered_dupes = partition(deduper, data_d, 0.5, block_cache)
+    print(
+        "block keys of %d records computed, %d from the cache"
+        % (block_cache.misses, block_cache.hits)
+    )
+    block_cache.close()
 
     print("# duplicate sets", len(clustered_dupes))
 
@@ -167,22 +287,13 @@ if __name__ == "__main__":
     # Write our original data back out to a CSV with a new column called
     # 'Cluster ID' which indicates which records refer to each other.
 
-    cluster_membership = {}
+    cluster_membership = ClusterMembership(row_index)
     for cluster_id, (records, scores) in enumerate(clustered_dupes):
         for record_id, score in zip(records, scores):
-            cluster_membership[record_id] = {
-                "Cluster ID": cluster_id,
-                "confidence_score": score,
-            }
-
-    with open(output_file, "w") as f_output, open(input_file) as f_input:
+            cluster_membership.add(record_id, cluster_id, score)
 
-        reader = csv.DictReader(f_input)
-        fieldnames = ["Cluster ID", "confidence_score"] + reader.fieldnames
-
-        writer = csv.DictWriter(f_output, fieldnames=fieldnames)
-        writer.writeheader()
+    write_results_file(
+        output_file, cluster_membership, columns=("Cluster ID", "confidence_score")
+    )
 
-        for row_id, row in enumerate(reader):
-            row.update(cluster_membership[row_id])
-            writer.writerow(row)
+    row_index.close()
@@ -0,0 +1,241 @@
+"""
+The steps of deduping the Illinois donors that don't depend on which
+database holds the data.
+
+A backend needs to be able to
+
+* give us the distinct values of a field, for building the indices of
+  any Index Predicates,
+* give us every donor, as `(donor_id, record)` tuples,
+* store the `(block_key, donor_id)` tuples we generate in a
+  `blocking_map` table,
+* give us every pair of donors that share a block key, as
+  `(donor_id, record, donor_id, record)` rows, with the smaller
+  donor_id first and each pair only once, and
+* store the `(donor_id, canon_id, cluster_score)` rows of our entity
+  map.
+
+`PostgresBackend` is in `pgsql_big_dedupe_example.py` and
+`DuckDBBackend` is in `duckdb_dedupe_example.py`.
+
+Steps that take a `budget`, a `shared.memory.MemoryBudget`, do their
+work in smaller pieces when memory gets tight.
+"""
+import csv
+import io
+import itertools
+import logging
+import os
+
+import dedupe
+
+DONOR_FIELDS = ("city", "name", "zip", "state", "address")
+
+DONOR_COLUMNS = "donor_id, " + ", ".join(DONOR_FIELDS)
+
+DONOR_SELECT = "SELECT " + DONOR_COLUMNS + " FROM processed_donors"
+
+
+class Readable:
+    def __init__(self, iterator, budget=None):
+        self.output = io.StringIO()
+        self.writer = csv.writer(self.output)
+        self.iterator = iterator
+        self.budget = budget
+        self.size = None
+
+    def read(self, size):
+        if self.budget is not None:
+            self.size = self.budget.shrink(self.size or size, "COPY")
+            size = min(size, self.size)
+
+        self.writer.writerows(itertools.islice(self.iterator, size))
+
+        chunk = self.output.getvalue()
+        self.output.seek(0)
+        self.output.truncate(0)
+
+        return chunk
+
+
+def record_pairs(result_set):
+    for i, row in enumerate(result_set):
+        a_record_id, a_record, b_record_id, b_record = row
+        record_a = (a_record_id, a_record)
+        record_b = (b_record_id, b_record)
+
+        yield record_a, record_b
+
+        if i % 10000 == 0:
+            print(i)
+
+
+def cluster_ids(clustered_dupes):
+    for cluster, scores in clustered_dupes:
+        cluster_id = cluster[0]
+        for donor_id, score in zip(cluster, scores):
+            yield donor_id, cluster_id, score
+
+
+def train(backend, settings_file, training_file, num_cores=4):
+    """
+    Load a deduper from the settings file or, if there isn't one yet,
+    train a new one by active learning and save its settings.
+    """
+    if os.path.exists(settings_file):
+        print("reading from ", settings_file)
+        with open(settings_file, "rb") as sf:
+            return dedupe.StaticDedupe(sf, num_cores=num_cores)
+
+    # Define the fields dedupe will pay attention to
+    #
+    # The address, city, and zip fields are often missing, so we'll
+    # tell dedupe that, and we'll learn a model that take that into
+    # account
+    fields = [
+        dedupe.variables.String("name"),
+        dedupe.variables.String("address", has_missing=True),
+        dedupe.variables.ShortString("city", has_missing=True),
+        dedupe.variables.ShortString("state", has_missing=True),
+        dedupe.variables.ShortString("zip", has_missing=True),
+    ]
+
+    # Create a new deduper object and pass our data model to it.
+    deduper = dedupe.Dedupe(fields, num_cores=num_cores)
+
+    temp_d = {i: record for i, (_, record) in enumerate(backend.donors())}
+
+    # If we have training data saved from a previous run of dedupe,
+    # look for it an load it in.
+    #
+    # __Note:__ if you want to train from
+    # scratch, delete the training_file
+    if os.path.exists(training_file):
+        print("reading labeled examples from ", training_file)
+        with open(training_file) as tf:
+            deduper.prepare_training(temp_d, tf)
+    else:
+        deduper.prepare_training(temp_d)
+
+    del temp_d
+
+    # ## Active learning
+
+    print("starting active labeling...")
+    # Starts the training loop. Dedupe will find the next pair of records
+    # it is least certain about and ask you to label them as duplicates
+    # or not.
+
+    # use 'y', 'n' and 'u' keys to flag duplicates
+    # press 'f' when you are finished
+    dedupe.console_label(deduper)
+    # When finished, save our labeled, training pairs to disk
+    with open(training_file, "w") as tf:
+        deduper.write_training(tf)
+
+    # Notice our argument here
+    #
+    # `recall` is the proportion of true dupes pairs that the learned
+    # rules must cover. You may want to reduce this if your are making
+    # too many blocks and too many comparisons.
+    deduper.train(recall=0.90)
+
+    with open(settings_file, "wb") as sf:
+        deduper.write_settings(sf)
+
+    # We can now remove some of the memory hogging objects we used
+    # for training
+    deduper.cleanup_training()
+
+    return deduper
+
+
+def index_fields(predicate):
+    """
+    The fields whose indices a predicate needs
+    """
+    # a compound predicate is made of simple predicates, and a simple
+    # predicate is made of itself
+    return frozenset(part.field for part in predicate if hasattr(part, "index"))
+
+
+def blocking_passes(fingerprinter, backend):
+    """
+    Yield the same `(block_key, donor_id)` tuples as the fingerprinter,
+    in one pass over the donors for each set of fields that predicates
+    need indices of. Only the indices of one pass are in memory at a
+    time; the block keys of the earlier passes are already on disk in
+    the blocking map.
+    """
+    passes = {}
+    for i, predicate in enumerate(fingerprinter.predicates):
+        passes.setdefault(index_fields(predicate), []).append((":" + str(i), predicate))
+
+    for fields, predicates in passes.items():
+        logging.info("blocking pass indexing %s", ", ".join(fields) or "nothing")
+        for field in fields:
+            fingerprinter.index(backend.field_values(field), field)
+
+        for donor_id, record in backend.donors():
+            for pred_id, predicate in predicates:
+                for block_key in predicate(record):
+                    yield block_key + pred_id, donor_id
+
+        fingerprinter.reset_indices()
+
+
+def block(deduper, backend, budget=None):
+    """
+    Write the blocking map: a table of `(block_key, donor_id)` rows.
+    """
+    fingerprinter = deduper.fingerprinter
+
+    # If dedupe learned a Index Predicate, we have to take a pass
+    # through the data and create indices.
+    print("creating inverted index")
+
+    fields = list(fingerprinter.index_fields)
+    in_passes = False
+    for i, field in enumerate(fields):
+        fingerprinter.index(backend.field_values(field), field)
+
+        # If the indices won't all fit, we block in several passes, with
+        # only the indices one pass needs in memory
+        if budget is not None and i + 1 < len(fields) and budget.near():
+            budget.spill(
+                "block keys, and only keeping the index postings of one "
+                "blocking pass in memory"
+            )
+            fingerprinter.reset_indices()
+            in_passes = True
+            break
+
+    # Now we are ready to write our blocking map table by creating a
+    # generator that yields unique `(block_key, donor_id)` tuples.
+    print("writing blocking map")
+
+    if in_passes:
+        b_data = blocking_passes(fingerprinter, backend)
+    else:
+        b_data = fingerprinter(backend.donors())
+    backend.write_blocking_map(b_data)
+
+    # free up memory by removing indices
+    fingerprinter.reset_indices()
+
+
+def cluster(deduper, backend, threshold=0.5):
+    """
+    Score every pair of donors that share a block key, cluster them
+    and write the clusters to the entity map.
+    """
+    print("clustering...")
+    clustered_dupes = deduper.cluster(
+        deduper.score(record_pairs(backend.candidate_pairs())), threshold=threshold
+    )
+
+    # We now have a sequence of tuples of donor ids that dedupe believes
+    # all refer to the same entity. We write this out onto an entity map
+    # table
+    print("writing results")
+    backend.write_entity_map(cluster_ids(clustered_dupes))
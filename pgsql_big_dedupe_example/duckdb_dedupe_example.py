@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""
+This is the same donor dedupe as `pgsql_big_dedupe_example.py`, but
+run on [DuckDB](https://duckdb.org), an embedded, columnar database. No
+database server is needed, which makes it handy for reruns on a laptop.
+
+Donors are loaded from a Parquet or CSV export of the
+`processed_donors` table, for example one made with
+
+    psql $DATABASE_URL -c "\\copy processed_donors TO 'processed_donors.csv' CSV HEADER"
+
+Block keys are written to DuckDB in Arrow batches, the pairs are
+generated with a single vectorized join and streamed into scoring, and
+the entity map is written back into the DuckDB file.
+
+The settings and training files are shared with
+`pgsql_big_dedupe_example.py`, so a model trained there can be reused
+here and the other way around.
+"""
+import logging
+import optparse
+import time
+
+import duckdb
+import pyarrow
+
+import donors_pipeline
+from donors_pipeline import DONOR_FIELDS, DONOR_SELECT
+
+
+def arrow_batches(cursor, batch_size):
+    """
+    Stream the result of the last query as Arrow record batches
+    """
+    # `fetch_record_batch` was renamed in duckdb 1.5
+    reader = getattr(cursor, "to_arrow_reader", None) or cursor.fetch_record_batch
+    return reader(batch_size)
+
+
+class DuckDBBackend:
+    """
+    Keep the donors, the blocking map and the entity map in a DuckDB
+    database.
+    """
+
+    def __init__(self, con, batch_size=100000):
+        self.con = con
+        self.batch_size = batch_size
+
+    def load_donors(self, filename):
+        """
+        Load `processed_donors` from a Parquet or CSV file
+        """
+        if filename.endswith(".parquet"):
+            source = "read_parquet(?)"
+        else:
+            source = "read_csv_auto(?, header=true)"
+
+        # CSV type sniffing would make numbers of zip codes, but dedupe
+        # compares them as strings
+        columns = ", ".join(
+            "CAST(%s AS VARCHAR) AS %s" % (field, field) for field in DONOR_FIELDS
+        )
+        self.con.execute(
+            "CREATE OR REPLACE TABLE processed_donors AS "
+            "SELECT CAST(donor_id AS INTEGER) AS donor_id, "
+            + columns
+            + " FROM "
+            + source,
+            [filename],
+        )
+
+    def field_values(self, field):
+        cur = self.con.cursor()
+        cur.execute("SELECT DISTINCT %s FROM processed_donors" % field)
+        for batch in arrow_batches(cur, self.batch_size):
+            yield from batch.column(0).to_pylist()
+
+    def donors(self):
+        cur = self.con.cursor()
+        cur.execute(DONOR_SELECT)
+        for batch in arrow_batches(cur, self.batch_size):
+            for row in batch.to_pylist():
+                yield row["donor_id"], row
+
+    def _append(self, table, columns, rows):
+        """
+        Insert rows into a table, one Arrow batch at a time
+        """
+        cur = self.con.cursor()
+        rows = iter(rows)
+        while True:
+            chunk = list(zip(*(row for _, row in zip(range(self.batch_size), rows))))
+            if not chunk:
+                break
+            batch = pyarrow.table(dict(zip(columns, chunk)))
+            cur.register("arrow_batch", batch)
+            cur.execute("INSERT INTO %s SELECT * FROM arrow_batch" % table)
+            cur.unregister("arrow_batch")
+
+    def write_blocking_map(self, b_data):
+        print("creating blocking_map database")
+        self.con.execute(
+            "CREATE OR REPLACE TABLE blocking_map (block_key VARCHAR, donor_id INTEGER)"
+        )
+        self._append("blocking_map", ("block_key", "donor_id"), b_data)
+
+    def candidate_pairs(self):
+        # DuckDB joins by hashing, so unlike PostgreSQL, we don't need to
+        # index the blocking map first
+        record = ", ".join("%%(side)s.%s" % field for field in DONOR_FIELDS)
+        cur = self.con.cursor()
+        cur.execute(
+            """
+               SELECT ids.east, struct_pack(%s),
+                      ids.west, struct_pack(%s)
+               FROM (SELECT DISTINCT l.donor_id AS east, r.donor_id AS west
+                     FROM blocking_map AS l
+                     INNER JOIN blocking_map AS r
+                     USING (block_key)
+                     WHERE l.donor_id < r.donor_id) ids
+               INNER JOIN processed_donors a ON ids.east=a.donor_id
+               INNER JOIN processed_donors b ON ids.west=b.donor_id"""
+            % (record % {"side": "a"}, record % {"side": "b"})
+        )
+        for batch in arrow_batches(cur, self.batch_size):
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+
+    def write_entity_map(self, rows):
+        print("creating entity_map database")
+        self.con.execute(
+            "CREATE OR REPLACE TABLE entity_map "
+            "(donor_id INTEGER, canon_id INTEGER, "
+            " cluster_score DOUBLE, PRIMARY KEY(donor_id))"
+        )
+        self._append(
+            "entity_map",
+            ("donor_id", "canon_id", "cluster_score"),
+            ((int(d), int(c), float(s)) for d, c, s in rows),
+        )
+
+
+if __name__ == "__main__":
+    # ## Logging
+
+    # To enable verbose output, run `python duckdb_dedupe_example.py -v`
+    optp = optparse.OptionParser()
+    optp.add_option(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="count",
+        help="Increase verbosity (specify multiple times for more)",
+    )
+    optp.add_option(
+        "--donors",
+        dest="donors",
+        default="processed_donors.parquet",
+        help="Parquet or CSV export of the processed_donors table",
+    )
+    optp.add_option(
+        "--database",
+        dest="database",
+        default="donors.duckdb",
+        help="DuckDB database file to write to",
+    )
+    (opts, args) = optp.parse_args()
+    log_level = logging.WARNING
+    if opts.verbose:
+        if opts.verbose == 1:
+            log_level = logging.INFO
+        elif opts.verbose >= 2:
+            log_level = logging.DEBUG
+    logging.getLogger().setLevel(log_level)
+
+    # ## Setup
+    settings_file = "pgsql_big_dedupe_example_settings"
+    training_file = "pgsql_big_dedupe_example_training.json"
+
+    start_time = time.time()
+
+    con = duckdb.connect(opts.database)
+    backend = DuckDBBackend(con)
+
+    print("importing donors from", opts.donors)
+    backend.load_donors(opts.donors)
+
+    # ## Training
+
+    deduper = donors_pipeline.train(backend, settings_file, training_file)
+
+    # ## Blocking
+    print("blocking...")
+
+    donors_pipeline.block(deduper, backend)
+
+    # ## Clustering
+
+    donors_pipeline.cluster(deduper, backend, threshold=0.5)
+
+    (n_clusters,) = con.execute(
+        "SELECT COUNT(DISTINCT canon_id) FROM entity_map"
+    ).fetchone()
+    print("# duplicate sets", n_clusters)
+
+    con.close()
+
+    print("ran in", time.time() - start_time, "seconds")
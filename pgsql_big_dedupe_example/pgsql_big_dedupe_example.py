@@ -15,65 +15,306 @@ before running this script.
 For smaller datasets (<10,000), see our
 [csv_example](http://datamade.github.io/dedupe-examples/docs/csv_example.html)
 """
-import csv
-import io
 import itertools
 import locale
 import logging
 import optparse
 import os
+import random
+import sys
 import time
 
-import dedupe
 import dj_database_url
 import numpy
 import psycopg2
 import psycopg2.extras
 from psycopg2.extensions import AsIs, register_adapter
 
+import donors_pipeline
+from donors_pipeline import DONOR_COLUMNS, Readable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared import tuning
+from shared.memory import MemoryBudget
+
 register_adapter(numpy.int32, AsIs)
 register_adapter(numpy.int64, AsIs)
 register_adapter(numpy.float32, AsIs)
 register_adapter(numpy.float64, AsIs)
 
 
-class Readable:
-    def __init__(self, iterator):
-
-        self.output = io.StringIO()
-        self.writer = csv.writer(self.output)
-        self.iterator = iterator
-
-    def read(self, size):
-
-        self.writer.writerows(itertools.islice(self.iterator, size))
+class PostgresBackend:
+    """
+    Keep the blocking map and the entity map in PostgreSQL. Reads go
+    through named, server side cursors on `read_con`, so we never hold
+    a whole result set in memory.
+
+    The donors are read from `processed_donors`, unless
+    `collapse_duplicates` has been called.
+
+    `copy_size` is the number of rows we send to the server in every
+    chunk of a `COPY`, and `itersize` the number of rows we fetch at a
+    time from a server side cursor. If there is a memory `budget`, both
+    shrink when we get close to it.
+    """
+
+    def __init__(
+        self, read_con, write_con, copy_size=10000, itersize=2000, budget=None
+    ):
+        self.read_con = read_con
+        self.write_con = write_con
+        self.donor_table = "processed_donors"
+        self.copy_size = copy_size
+        self.itersize = itersize
+        self.budget = budget
+
+    def _fetch(self, cur):
+        for i, row in enumerate(cur, 1):
+            yield row
+            if self.budget is not None and i % cur.itersize == 0:
+                cur.itersize = self.budget.shrink(cur.itersize, "cursor")
+
+    def collapse_duplicates(self):
+        """
+        Pick one representative from every group of donors that are
+        identical in all the fields dedupe uses, and only dedupe those.
+        The `donor_twins` table maps every donor to its representative.
+        Identical donors then always share a cluster, and every
+        representative is clustered as one donor, however many it
+        stands for.
+        """
+        fields = ", ".join(donors_pipeline.DONOR_FIELDS)
+        with self.write_con:
+            with self.write_con.cursor() as cur:
+                cur.execute("DROP TABLE IF EXISTS donor_twins")
+                # Window partitions, like GROUP BY, put NULLs together
+                cur.execute(
+                    "CREATE TABLE donor_twins AS "
+                    "SELECT donor_id, "
+                    "       MIN(donor_id) OVER (PARTITION BY %s) AS rep_id "
+                    "FROM processed_donors" % fields
+                )
+                cur.execute("CREATE INDEX ON donor_twins (rep_id)")
+
+                cur.execute("DROP TABLE IF EXISTS unique_donors")
+                cur.execute(
+                    "CREATE TABLE unique_donors AS "
+                    "SELECT %s FROM processed_donors "
+                    "INNER JOIN donor_twins USING (donor_id) "
+                    "WHERE donor_id = rep_id" % DONOR_COLUMNS
+                )
+                cur.execute("ALTER TABLE unique_donors ADD PRIMARY KEY (donor_id)")
 
-        chunk = self.output.getvalue()
-        self.output.seek(0)
-        self.output.truncate(0)
+                cur.execute(
+                    "SELECT COUNT(*), COUNT(DISTINCT rep_id) FROM donor_twins"
+                )
+                n_donors, n_unique = cur.fetchone()
+
+        self.donor_table = "unique_donors"
+
+        return n_donors, n_unique
+
+    def expand_entity_map(self):
+        """
+        Give every donor the cluster of its representative. A
+        representative that dedupe left on its own starts a cluster
+        with its twins.
+        """
+        with self.write_con:
+            with self.write_con.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO entity_map (donor_id, canon_id, cluster_score) "
+                    "SELECT DISTINCT rep_id, rep_id, 1.0 FROM donor_twins "
+                    "WHERE donor_id <> rep_id "
+                    "ON CONFLICT (donor_id) DO NOTHING"
+                )
+                cur.execute(
+                    "INSERT INTO entity_map (donor_id, canon_id, cluster_score) "
+                    "SELECT donor_twins.donor_id, canon_id, cluster_score "
+                    "FROM donor_twins INNER JOIN entity_map "
+                    "ON entity_map.donor_id = donor_twins.rep_id "
+                    "WHERE donor_twins.donor_id <> rep_id"
+                )
 
-        return chunk
+    def field_values(self, field):
+        with self.read_con.cursor("field_values") as cur:
+            cur.itersize = self.itersize
+            cur.execute("SELECT DISTINCT %s FROM %s" % (field, self.donor_table))
+            for row in self._fetch(cur):
+                yield row[field]
+
+    def donors(self):
+        with self.read_con.cursor("donor_select") as cur:
+            cur.itersize = self.itersize
+            cur.execute("SELECT %s FROM %s" % (DONOR_COLUMNS, self.donor_table))
+            for row in self._fetch(cur):
+                yield row["donor_id"], row
+
+    def write_blocking_map(self, b_data):
+        # To run blocking on such a large set of data, we create a
+        # separate table that contains blocking keys and record ids
+        print("creating blocking_map database")
+        with self.write_con:
+            with self.write_con.cursor() as cur:
+                cur.execute("DROP TABLE IF EXISTS blocking_map")
+                cur.execute(
+                    "CREATE TABLE blocking_map " "(block_key text, donor_id INTEGER)"
+                )
 
+        with self.write_con:
+            with self.write_con.cursor() as cur:
+                cur.copy_expert(
+                    "COPY blocking_map FROM STDIN WITH CSV",
+                    Readable(b_data, self.budget),
+                    size=self.copy_size,
+                )
 
-def record_pairs(result_set):
+        logging.info("indexing block_key")
+        with self.write_con:
+            with self.write_con.cursor() as cur:
+                cur.execute(
+                    "CREATE UNIQUE INDEX ON blocking_map "
+                    "(block_key text_pattern_ops, donor_id)"
+                )
 
-    for i, row in enumerate(result_set):
-        a_record_id, a_record, b_record_id, b_record = row
-        record_a = (a_record_id, a_record)
-        record_b = (b_record_id, b_record)
+    def candidate_pairs(self):
+        with self.read_con.cursor(
+            "pairs", cursor_factory=psycopg2.extensions.cursor
+        ) as cur:
+            cur.itersize = self.itersize
+            cur.execute(
+                """
+                   select a.donor_id,
+                          row_to_json((select d from (select a.city,
+                                                             a.name,
+                                                             a.zip,
+                                                             a.state,
+                                                             a.address) d)),
+                          b.donor_id,
+                          row_to_json((select d from (select b.city,
+                                                             b.name,
+                                                             b.zip,
+                                                             b.state,
+                                                             b.address) d))
+                   from (select DISTINCT l.donor_id as east, r.donor_id as west
+                         from blocking_map as l
+                         INNER JOIN blocking_map as r
+                         using (block_key)
+                         where l.donor_id < r.donor_id) ids
+                   INNER JOIN {table} a on ids.east=a.donor_id
+                   INNER JOIN {table} b on ids.west=b.donor_id""".format(
+                    table=self.donor_table
+                )
+            )
+            yield from self._fetch(cur)
+
+    def write_entity_map(self, rows):
+        with self.write_con:
+            with self.write_con.cursor() as cur:
+                cur.execute("DROP TABLE IF EXISTS entity_map")
+
+                print("creating entity_map database")
+                cur.execute(
+                    "CREATE TABLE entity_map "
+                    "(donor_id INTEGER, canon_id INTEGER, "
+                    " cluster_score FLOAT, PRIMARY KEY(donor_id))"
+                )
 
-        yield record_a, record_b
+        with self.write_con:
+            with self.write_con.cursor() as cur:
+                cur.copy_expert(
+                    "COPY entity_map FROM STDIN WITH CSV",
+                    Readable(rows, self.budget),
+                    size=self.copy_size,
+                )
 
-        if i % 10000 == 0:
-            print(i)
+        with self.write_con:
+            with self.write_con.cursor() as cur:
+                cur.execute("CREATE INDEX head_index ON entity_map (canon_id)")
+
+    # ## Calibration probes
+
+    def probe_copy(self, rows, size):
+        """
+        `COPY` rows into a temporary table, `size` rows at a time.
+        Returns the number of rows and of bytes copied.
+        """
+        with self.write_con:
+            with self.write_con.cursor() as cur:
+                cur.execute(
+                    "CREATE TEMPORARY TABLE copy_probe "
+                    "(block_key text, donor_id INTEGER) ON COMMIT DROP"
+                )
+                cur.copy_expert(
+                    "COPY copy_probe FROM STDIN WITH CSV",
+                    Readable(iter(rows)),
+                    size=size,
+                )
 
+        n_bytes = sum(len(str(value)) + 1 for row in rows for value in row)
+        return len(rows), n_bytes
+
+    def probe_read(self, n_rows, itersize):
+        """
+        Read `n_rows` donors through a server side cursor, `itersize`
+        rows at a time. Returns the number of rows and roughly the
+        number of bytes read.
+        """
+        rows = 0
+        n_bytes = 0
+        with self.read_con:
+            with self.read_con.cursor("read_probe") as cur:
+                cur.itersize = itersize
+                cur.execute(
+                    "SELECT %s FROM %s LIMIT %%s" % (DONOR_COLUMNS, self.donor_table),
+                    (n_rows,),
+                )
+                for row in cur:
+                    rows += 1
+                    n_bytes += sum(len(str(value)) for value in row.values())
+        return rows, n_bytes
+
+
+def calibrate(deduper, backend, max_memory, sample_size=20000):
+    """
+    Time scoring and I/O on a sample of the donors and return a profile
+    with the number of cores and batch sizes to use on this machine.
+    """
+    print("sampling donors")
+    sample = list(itertools.islice(backend.donors(), sample_size))
+
+    # Scoring takes about as long for any pair of records, so random
+    # pairs will do
+    rng = random.Random(0)
+    record_pairs = []
+    for _ in range(sample_size):
+        a, b = sorted(rng.sample(sample, 2))
+        record_pairs.append((a, b))
+
+    print("timing scoring")
+    num_cores, results = tuning.calibrate_cores(
+        deduper, record_pairs, max_memory=max_memory
+    )
+    tuning.print_results("num_cores", results, "pairs/s")
+
+    print("timing COPY")
+    rows = [(record["name"], donor_id) for donor_id, record in sample] * 10
+    copy_size, results = tuning.calibrate_batches(
+        lambda size: backend.probe_copy(rows, size),
+        [1000, 10000, 50000, 100000],
+        max_memory=max_memory,
+    )
+    tuning.print_results("copy_size", results, "rows/s")
 
-def cluster_ids(clustered_dupes):
+    print("timing reads")
+    itersize, results = tuning.calibrate_batches(
+        lambda size: backend.probe_read(len(rows), size),
+        [2000, 10000, 50000, 100000],
+        max_memory=max_memory,
+    )
+    tuning.print_results("itersize", results, "rows/s")
 
-    for cluster, scores in clustered_dupes:
-        cluster_id = cluster[0]
-        for donor_id, score in zip(cluster, scores):
-            yield donor_id, cluster_id, score
+    return {"num_cores": num_cores, "copy_size": copy_size, "itersize": itersize}
 
 
 if __name__ == "__main__":
@@ -90,6 +331,31 @@ if __name__ == "__main__":
         action="count",
         help="Increase verbosity (specify multiple times for more)",
     )
+    optp.add_option(
+        "--collapse-duplicates",
+        dest="collapse_duplicates",
+        action="store_true",
+        help="Only compare one of each set of identical donors",
+    )
+    optp.add_option(
+        "--calibrate",
+        dest="calibrate",
+        action="store_true",
+        help="Time the number of cores and batch sizes on a sample, "
+        "save the best to the profile and exit",
+    )
+    optp.add_option(
+        "--profile",
+        dest="profile",
+        default="pgsql_big_dedupe_example_profile.json",
+        help="Profile with the number of cores and batch sizes to use",
+    )
+    optp.add_option(
+        "--max-memory",
+        dest="max_memory",
+        help="Memory this run may use, like 4G. Batches shrink and "
+        "blocking works in passes when we get close to it",
+    )
     (opts, args) = optp.parse_args()
     log_level = logging.WARNING
     if opts.verbose:
@@ -132,201 +398,62 @@ if __name__ == "__main__":
         host=db_conf["HOST"],
     )
 
-    # We'll be using variations on this following select statement to pull
-    # in campaign donor info.
-    #
     # We did a fair amount of preprocessing of the fields in
-    # `pgsql_big_dedupe_example_init_db.py`
-
-    DONOR_SELECT = (
-        "SELECT donor_id, city, name, zip, state, address " "from processed_donors"
+    # `pgsql_big_dedupe_example_init_db.py`. The steps that don't depend
+    # on PostgreSQL are in [donors_pipeline.py](donors_pipeline.html),
+    # everything that talks to the database is in `PostgresBackend`.
+    #
+    # The number of cores and the batch sizes depend on the machine. A
+    # calibration run with `--calibrate` picks them and saves them to a
+    # profile, which we apply on every later run.
+    #
+    # With `--max-memory`, we watch how much memory we use, and work in
+    # smaller pieces when we get close to it.
+    profile = tuning.load_profile(opts.profile)
+    if profile:
+        print("using", opts.profile, profile)
+
+    max_memory = tuning.parse_size(opts.max_memory) if opts.max_memory else None
+    budget = MemoryBudget(max_memory) if max_memory else None
+
+    backend = PostgresBackend(
+        read_con,
+        write_con,
+        copy_size=profile.get("copy_size", 10000),
+        itersize=profile.get("itersize", 2000),
+        budget=budget,
     )
 
+    # Contributions often come from the same donor again and again, so
+    # many processed donors are identical in every field. Blocking and
+    # scoring those only once saves a lot of comparisons.
+    if opts.collapse_duplicates:
+        n_donors, n_unique = backend.collapse_duplicates()
+        print("deduping", n_unique, "distinct donors out of", n_donors)
+
     # ## Training
 
-    if os.path.exists(settings_file):
-        print("reading from ", settings_file)
-        with open(settings_file, "rb") as sf:
-            deduper = dedupe.StaticDedupe(sf, num_cores=4)
-    else:
-
-        # Define the fields dedupe will pay attention to
-        #
-        # The address, city, and zip fields are often missing, so we'll
-        # tell dedupe that, and we'll learn a model that take that into
-        # account
-        fields = [
-            dedupe.variables.String("name"),
-            dedupe.variables.String("address", has_missing=True),
-            dedupe.variables.ShortString("city", has_missing=True),
-            dedupe.variables.ShortString("state", has_missing=True),
-            dedupe.variables.ShortString("zip", has_missing=True),
-        ]
-
-        # Create a new deduper object and pass our data model to it.
-        deduper = dedupe.Dedupe(fields, num_cores=4)
-
-        # Named cursor runs server side with psycopg2
-        with read_con.cursor("donor_select") as cur:
-            cur.execute(DONOR_SELECT)
-            temp_d = {i: row for i, row in enumerate(cur)}
-
-        # If we have training data saved from a previous run of dedupe,
-        # look for it an load it in.
-        #
-        # __Note:__ if you want to train from
-        # scratch, delete the training_file
-        if os.path.exists(training_file):
-            print("reading labeled examples from ", training_file)
-            with open(training_file) as tf:
-                deduper.prepare_training(temp_d, tf)
-        else:
-            deduper.prepare_training(temp_d)
-
-        del temp_d
-
-        # ## Active learning
-
-        print("starting active labeling...")
-        # Starts the training loop. Dedupe will find the next pair of records
-        # it is least certain about and ask you to label them as duplicates
-        # or not.
-
-        # use 'y', 'n' and 'u' keys to flag duplicates
-        # press 'f' when you are finished
-        dedupe.console_label(deduper)
-        # When finished, save our labeled, training pairs to disk
-        with open(training_file, "w") as tf:
-            deduper.write_training(tf)
-
-        # Notice our argument here
-        #
-        # `recall` is the proportion of true dupes pairs that the learned
-        # rules must cover. You may want to reduce this if your are making
-        # too many blocks and too many comparisons.
-        deduper.train(recall=0.90)
-
-        with open(settings_file, "wb") as sf:
-            deduper.write_settings(sf)
-
-        # We can now remove some of the memory hogging objects we used
-        # for training
-        deduper.cleanup_training()
+    deduper = donors_pipeline.train(
+        backend, settings_file, training_file, num_cores=profile.get("num_cores", 4)
+    )
+
+    if opts.calibrate:
+        profile = calibrate(deduper, backend, max_memory)
+        tuning.save_profile(opts.profile, profile)
+        print("saved", profile, "to", opts.profile)
+        sys.exit()
 
     # ## Blocking
     print("blocking...")
 
-    # To run blocking on such a large set of data, we create a separate table
-    # that contains blocking keys and record ids
-    print("creating blocking_map database")
-    with write_con:
-        with write_con.cursor() as cur:
-            cur.execute("DROP TABLE IF EXISTS blocking_map")
-            cur.execute(
-                "CREATE TABLE blocking_map " "(block_key text, donor_id INTEGER)"
-            )
-
-    # If dedupe learned a Index Predicate, we have to take a pass
-    # through the data and create indices.
-    print("creating inverted index")
-
-    for field in deduper.fingerprinter.index_fields:
-        with read_con.cursor("field_values") as cur:
-            cur.execute("SELECT DISTINCT %s FROM processed_donors" % field)
-            field_data = (row[field] for row in cur)
-            deduper.fingerprinter.index(field_data, field)
-
-    # Now we are ready to write our blocking map table by creating a
-    # generator that yields unique `(block_key, donor_id)` tuples.
-    print("writing blocking map")
-
-    with read_con.cursor("donor_select") as read_cur:
-        read_cur.execute(DONOR_SELECT)
-
-        full_data = ((row["donor_id"], row) for row in read_cur)
-        b_data = deduper.fingerprinter(full_data)
-
-        with write_con:
-            with write_con.cursor() as write_cur:
-                write_cur.copy_expert(
-                    "COPY blocking_map FROM STDIN WITH CSV",
-                    Readable(b_data),
-                    size=10000,
-                )
-
-    # free up memory by removing indices
-    deduper.fingerprinter.reset_indices()
-
-    logging.info("indexing block_key")
-    with write_con:
-        with write_con.cursor() as cur:
-            cur.execute(
-                "CREATE UNIQUE INDEX ON blocking_map "
-                "(block_key text_pattern_ops, donor_id)"
-            )
+    donors_pipeline.block(deduper, backend, budget)
 
     # ## Clustering
 
-    with write_con:
-        with write_con.cursor() as cur:
-            cur.execute("DROP TABLE IF EXISTS entity_map")
-
-            print("creating entity_map database")
-            cur.execute(
-                "CREATE TABLE entity_map "
-                "(donor_id INTEGER, canon_id INTEGER, "
-                " cluster_score FLOAT, PRIMARY KEY(donor_id))"
-            )
-
-    with read_con.cursor(
-        "pairs", cursor_factory=psycopg2.extensions.cursor
-    ) as read_cur:
-        read_cur.execute(
-            """
-               select a.donor_id,
-                      row_to_json((select d from (select a.city,
-                                                         a.name,
-                                                         a.zip,
-                                                         a.state,
-                                                         a.address) d)),
-                      b.donor_id,
-                      row_to_json((select d from (select b.city,
-                                                         b.name,
-                                                         b.zip,
-                                                         b.state,
-                                                         b.address) d))
-               from (select DISTINCT l.donor_id as east, r.donor_id as west
-                     from blocking_map as l
-                     INNER JOIN blocking_map as r
-                     using (block_key)
-                     where l.donor_id < r.donor_id) ids
-               INNER JOIN processed_donors a on ids.east=a.donor_id
-               INNER JOIN processed_donors b on ids.west=b.donor_id"""
-        )
-
-        print("clustering...")
-        clustered_dupes = deduper.cluster(
-            deduper.score(record_pairs(read_cur)), threshold=0.5
-        )
-
-        # ## Writing out results
-
-        # We now have a sequence of tuples of donor ids that dedupe believes
-        # all refer to the same entity. We write this out onto an entity map
-        # table
-
-        print("writing results")
-        with write_con:
-            with write_con.cursor() as write_cur:
-                write_cur.copy_expert(
-                    "COPY entity_map FROM STDIN WITH CSV",
-                    Readable(cluster_ids(clustered_dupes)),
-                    size=10000,
-                )
+    donors_pipeline.cluster(deduper, backend, threshold=0.5)
 
-    with write_con:
-        with write_con.cursor() as cur:
-            cur.execute("CREATE INDEX head_index ON entity_map (canon_id)")
+    if opts.collapse_duplicates:
+        backend.expand_entity_map()
 
     # Print out the number of duplicates found
 
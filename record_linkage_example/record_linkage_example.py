@@ -7,53 +7,55 @@ online stores. The task is to link products between the datasets.
 The output will be a CSV with our linkded results.
 
 """
-import csv
 import logging
 import optparse
 import os
-import re
+import sys
 
 import dedupe
-from unidecode import unidecode
 
-
-def preProcess(column):
-    """
-    Do a little bit of data cleaning with the help of Unidecode and Regex.
-    Things like casing, extra spaces, quotes and new lines can be ignored.
-    """
-
-    column = unidecode(column)
-    column = re.sub("\n", " ", column)
-    column = re.sub("-", "", column)
-    column = re.sub("/", " ", column)
-    column = re.sub("'", "", column)
-    column = re.sub(",", "", column)
-    column = re.sub(":", " ", column)
-    column = re.sub("  +", " ", column)
-    column = column.strip().strip('"').strip("'").lower().strip()
-    if not column:
-        column = None
-    return column
-
-
-def readData(filename):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared import minhash
+from shared.corpus import CorpusCache
+from shared.csvio import RowIndex, read_csv
+from shared.normalize import Normalizer
+from shared.results import ClusterMembership, write_results
+from shared.topk import TopKCandidates
+
+
+# Do a little bit of data cleaning with the help of Unidecode and Regex.
+# Things like casing, extra spaces, quotes and new lines can be ignored.
+# If data is missing, indicate that by setting the value to `None`.
+preProcess = Normalizer(
+    [
+        ("\n", " "),
+        ("-", ""),
+        ("/", " "),
+        ("'", ""),
+        (",", ""),
+        (":", " "),
+        ("  +", " "),
+    ]
+)
+
+
+def cleanRow(row):
+    clean_row = {k: preProcess(v) for (k, v) in row.items()}
+    if clean_row["price"]:
+        clean_row["price"] = float(clean_row["price"][1:])
+    return clean_row
+
+
+def readData(filename, row_index=None):
     """
     Read in our data from a CSV file and create a dictionary of records,
     where the key is a unique record ID.
-    """
-
-    data_d = {}
 
-    with open(filename) as f:
-        reader = csv.DictReader(f)
-        for i, row in enumerate(reader):
-            clean_row = {k: preProcess(v) for (k, v) in row.items()}
-            if clean_row["price"]:
-                clean_row["price"] = float(clean_row["price"][1:])
-            data_d[filename + str(i)] = dict(clean_row)
+    If there is a `row_index`, it learns where each record's row is in
+    the file.
+    """
 
-    return data_d
+    return read_csv(filename, cleanRow, id_prefix=filename, row_index=row_index)
 
 
 if __name__ == "__main__":
@@ -70,7 +72,39 @@ if __name__ == "__main__":
         action="count",
         help="Increase verbosity (specify multiple times for more)",
     )
+    optp.add_option(
+        "--top-k",
+        dest="top_k",
+        type="int",
+        help="Instead of blocking, compare every Abt record with the K Buy "
+        "records most similar to it by TF-IDF",
+    )
+    optp.add_option(
+        "--blocking",
+        dest="blocking",
+        type="choice",
+        choices=["learned", "minhash", "both"],
+        default="learned",
+        help="Block with the learned predicates, MinHash-LSH on the titles, "
+        "or both",
+    )
+    optp.add_option(
+        "--bands",
+        dest="bands",
+        type="int",
+        default=minhash.BANDS,
+        help="MinHash-LSH bands, more find more pairs",
+    )
+    optp.add_option(
+        "--rows",
+        dest="rows",
+        type="int",
+        default=minhash.ROWS,
+        help="MinHash-LSH rows per band, more find fewer, more similar pairs",
+    )
     (opts, args) = optp.parse_args()
+    if opts.top_k and opts.blocking != "learned":
+        optp.error("--blocking doesn't work with --top-k")
     log_level = logging.WARNING
     if opts.verbose:
         if opts.verbose == 1:
@@ -84,13 +118,16 @@ if __name__ == "__main__":
     output_file = "data_matching_output.csv"
     settings_file = "data_matching_learned_settings"
     training_file = "data_matching_training.json"
+    corpus_file = "data_matching_corpus.db"
 
     left_file = "AbtBuy_Abt.csv"
     right_file = "AbtBuy_Buy.csv"
 
     print("importing data ...")
-    data_1 = readData(left_file)
-    data_2 = readData(right_file)
+    left_index = RowIndex(left_file)
+    right_index = RowIndex(right_file)
+    data_1 = readData(left_file, left_index)
+    data_2 = readData(right_file, right_index)
 
     def descriptions():
         for dataset in (data_1, data_2):
@@ -105,15 +142,23 @@ if __name__ == "__main__":
             linker = dedupe.StaticRecordLink(sf)
 
     else:
-        # Define the fields the linker will pay attention to
+        # Define the fields the linker will pay attention to. The document
+        # frequencies of the descriptions are kept in `corpus_file`
+        # between runs, and only counted again for new records.
+        corpus_cache = CorpusCache(corpus_file)
         fields = [
             dedupe.variables.String("title"),
             dedupe.variables.Text("title"),
-            dedupe.variables.Text(
-                "description", corpus=descriptions(), has_missing=True
+            corpus_cache.text_variable(
+                "description", "descriptions", descriptions, has_missing=True
             ),
             dedupe.variables.Price("price", has_missing=True),
         ]
+        print(
+            "document frequencies of %d documents counted, %d from the cache"
+            % (corpus_cache.counted, corpus_cache.cached)
+        )
+        corpus_cache.close()
 
         # Create a new linker object and pass our data model to it.
         linker = dedupe.RecordLink(fields)
@@ -154,6 +199,31 @@ if __name__ == "__main__":
 
     # ## Blocking
 
+    # With `--top-k`, instead of the learned blocking predicates, `join`
+    # compares every record of `data_1` with the `top_k` records of
+    # `data_2` most similar to it, so there are always the same number
+    # of pairs to score.
+    if opts.top_k:
+        linker.pairs = TopKCandidates(("title", "description"), k=opts.top_k).pairs
+
+    # With `--blocking minhash`, `join` compares the records whose titles
+    # are in the same MinHash-LSH block instead, and with `--blocking
+    # both`, those and the pairs the learned predicates find. To see how
+    # many pairs, and how many of the labeled matches, every blocking
+    # finds, run `record_linkage_blocking_report.py`.
+    if opts.blocking != "learned":
+        lsh = minhash.MinHashLSH(("title",), opts.bands, opts.rows)
+        learned_pairs = linker.pairs
+
+        def pairs(data_1, data_2):
+            id_pairs = lsh.candidates(data_1, data_2)
+            if opts.blocking == "both":
+                learned_ids = minhash.pair_ids(learned_pairs(data_1, data_2))
+                id_pairs = minhash.union(learned_ids, id_pairs)
+            return minhash.record_pairs(id_pairs, data_1, data_2)
+
+        linker.pairs = pairs
+
     # ## Clustering
 
     # Find the threshold that will maximize a weighted average of our
@@ -172,40 +242,15 @@ if __name__ == "__main__":
     # Write our original data back out to a CSV with a new column called
     # 'Cluster ID' which indicates which records refer to each other.
 
-    cluster_membership = {}
+    cluster_membership = ClusterMembership(left_index, right_index)
     for cluster_id, (cluster, score) in enumerate(linked_records):
         for record_id in cluster:
-            cluster_membership[record_id] = {
-                "Cluster ID": cluster_id,
-                "Link Score": score,
-            }
+            cluster_membership.add(record_id, cluster_id, score)
 
     with open(output_file, "w") as f:
-
-        header_unwritten = True
-
-        for fileno, filename in enumerate((left_file, right_file)):
-            with open(filename) as f_input:
-                reader = csv.DictReader(f_input)
-
-                if header_unwritten:
-
-                    fieldnames = [
-                        "Cluster ID",
-                        "Link Score",
-                        "source file",
-                    ] + reader.fieldnames
-
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
-
-                    header_unwritten = False
-
-                for row_id, row in enumerate(reader):
-
-                    record_id = filename + str(row_id)
-                    cluster_details = cluster_membership.get(record_id, {})
-                    row["source file"] = fileno
-                    row.update(cluster_details)
-
-                    writer.writerow(row)
+        write_results(
+            f,
+            cluster_membership,
+            columns=("Cluster ID", "Link Score"),
+            source_column="source file",
+        )
@@ -0,0 +1,6 @@
+"""
+Code shared by more than one of the examples.
+
+The examples are run as scripts from their own directories, so they add
+the root of this repository to `sys.path` before importing from here.
+"""
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Compare loading records from, and writing results to, CSV and Parquet
+files, on the data of the csv and patent examples.
+
+For every example we convert its input to Parquet, check that reading
+either file with the example's `readData` gives the same records, and
+then time:
+
+- loading the records with `readData`, from the CSV and from the Parquet
+  file,
+- writing every row back out with a cluster ID and a score, to a CSV
+  and to a Parquet file.
+
+Run it from the root of the repository:
+
+    python shared/arrow_benchmark.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+sys.path.insert(0, ROOT)
+from shared.arrowio import csv_to_parquet, row_index_for, write_results_file
+from shared.normalize_benchmark import load_example
+from shared.results import ClusterMembership
+
+CASES = [
+    ("csv_example/csv_example.py", "csv_example/csv_example_messy_input.csv"),
+    ("patent_example/patent_example.py", "patent_example/patstat_input.csv"),
+]
+
+REPEAT = 3
+
+
+def best_of(function, *args):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def load(example, filename):
+    row_index = row_index_for(filename)
+    data_d = example.readData(filename, row_index=row_index)
+    return data_d, row_index
+
+
+def write(filename, row_index, data_d):
+    # every record in a cluster of its own
+    membership = ClusterMembership(row_index)
+    for cluster_id, record_id in enumerate(data_d):
+        membership.add(record_id, cluster_id, 1.0)
+    write_results_file(filename, membership, columns=("Cluster ID", "confidence_score"))
+
+
+if __name__ == "__main__":
+    print(
+        "%-16s %8s %10s %10s %10s %10s"
+        % ("example", "rows", "csv load", "pq load", "csv write", "pq write")
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for path, input_file in CASES:
+            name = os.path.splitext(os.path.basename(path))[0]
+            try:
+                example = load_example(path)
+            except ImportError as e:
+                print("%-16s skipped, %s" % (name, e))
+                continue
+
+            csv_file = os.path.join(ROOT, input_file)
+            parquet_file = os.path.join(tmp, name + ".parquet")
+            csv_to_parquet(csv_file, parquet_file)
+
+            csv_load, (csv_data, csv_index) = best_of(load, example, csv_file)
+            pq_load, (pq_data, pq_index) = best_of(load, example, parquet_file)
+            assert dict(csv_data) == dict(pq_data)
+
+            csv_write, _ = best_of(
+                write, os.path.join(tmp, name + "_output.csv"), csv_index, csv_data
+            )
+            pq_write, _ = best_of(
+                write, os.path.join(tmp, name + "_output.parquet"), pq_index, pq_data
+            )
+
+            print(
+                "%-16s %8d %9.3fs %9.3fs %9.3fs %9.3fs"
+                % (name, len(csv_data), csv_load, pq_load, csv_write, pq_write)
+            )
@@ -0,0 +1,308 @@
+"""
+Read records from Parquet files, and write results to them, with
+pyarrow.
+
+If the data already lives in Parquet, going through CSV means writing
+all of it out as text, and parsing the text again on every run. Here
+we read the file a batch of rows at a time, and every row goes
+straight from the batch into the dictionary of records, or into a
+`shared.records.RecordStore`.
+
+The rows look like the ones `csv.DictReader` makes: every value is a
+string, and a missing value is an empty string. That way the same
+`cleanRow` works for CSV and Parquet input.
+
+`write_results_parquet` is the Parquet version of
+`shared.results.write_results`. It reads the input files, CSV or
+Parquet, a batch at a time, and adds the cluster columns to each batch
+as whole columns.
+"""
+
+import bisect
+import csv
+import itertools
+
+import numpy
+import pyarrow
+import pyarrow.compute
+import pyarrow.csv
+import pyarrow.parquet
+
+from .csvio import RowIndex, read_csv
+from .results import write_results
+
+BATCH_SIZE = 2**16
+
+
+def is_parquet(filename):
+    return filename.endswith((".parquet", ".pq"))
+
+
+def text_columns(batch):
+    """
+    The columns of a record batch as lists of strings, with empty
+    strings for nulls
+    """
+    return [
+        pyarrow.compute.fill_null(column.cast(pyarrow.string()), "").to_pylist()
+        for column in batch.columns
+    ]
+
+
+def as_text(value):
+    if value is None:
+        return ""
+    return str(value)
+
+
+class ParquetIndex:
+    """
+    The position of each record's row in a Parquet file, like a
+    `shared.csvio.RowIndex` for a CSV file. A full row is read back by
+    reading the row group it is in.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fieldnames = None
+        self._positions = {}
+        self._file = None
+        self._group_starts = None
+        self._group = None
+
+    def add(self, record_id, position):
+        self._positions[record_id] = position
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, record_id):
+        return record_id in self._positions
+
+    def position(self, record_id):
+        """
+        The position of a record's row among all the indexed rows
+        """
+        return self._positions[record_id]
+
+    def row(self, record_id):
+        """
+        Read the full row of a record back from the file, as a
+        dictionary of strings
+        """
+        if self._file is None:
+            self._file = pyarrow.parquet.ParquetFile(self.filename)
+            metadata = self._file.metadata
+            self._group_starts = list(
+                itertools.accumulate(
+                    (
+                        metadata.row_group(i).num_rows
+                        for i in range(metadata.num_row_groups)
+                    ),
+                    initial=0,
+                )
+            )
+
+        position = self._positions[record_id]
+        i = bisect.bisect_right(self._group_starts, position) - 1
+        # Rows are usually wanted in order, so we hold on to the last
+        # row group we read
+        if self._group is None or self._group[0] != i:
+            self._group = (i, self._file.read_row_group(i))
+        table = self._group[1]
+        (row,) = table.slice(position - self._group_starts[i], 1).to_pylist()
+        return {k: as_text(v) for k, v in row.items()}
+
+    def rows(self):
+        """
+        Yield `(record_id, row)` for every record, in file order
+        """
+        for record_id in self._positions:
+            yield record_id, self.row(record_id)
+
+    def scan(self):
+        """
+        Yield every row as a list of strings, in file order
+        """
+        parquet_file = pyarrow.parquet.ParquetFile(self.filename)
+        for batch in parquet_file.iter_batches(batch_size=BATCH_SIZE):
+            for row in zip(*text_columns(batch)):
+                yield list(row)
+
+    def batches(self):
+        """
+        Read the file a batch of rows at a time, as pyarrow record
+        batches
+        """
+        parquet_file = pyarrow.parquet.ParquetFile(self.filename)
+        return parquet_file.iter_batches(batch_size=BATCH_SIZE)
+
+    def close(self):
+        self._file = None
+        self._group = None
+
+
+def read_parquet(
+    filename,
+    clean_row,
+    id_column=None,
+    id_type=int,
+    id_prefix=None,
+    batch_size=BATCH_SIZE,
+    data_d=None,
+    row_index=None,
+):
+    """
+    Read a Parquet file into a dictionary of records, or into `data_d`
+    if it is given. Takes the same arguments as `shared.csvio.read_csv`,
+    and if there is a `row_index`, it should be a `ParquetIndex`.
+    """
+    parquet_file = pyarrow.parquet.ParquetFile(filename)
+    fieldnames = parquet_file.schema_arrow.names
+
+    if row_index is not None:
+        row_index.fieldnames = fieldnames
+
+    if data_d is None:
+        data_d = {}
+
+    i = 0
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        for values in zip(*text_columns(batch)):
+            row = dict(zip(fieldnames, values))
+            if id_column is None:
+                record_id = i if id_prefix is None else id_prefix + str(i)
+            else:
+                record_id = id_type(row[id_column])
+            data_d[record_id] = clean_row(row)
+            if row_index is not None:
+                row_index.add(record_id, i)
+            i += 1
+
+    return data_d
+
+
+def csv_batches(filename, fieldnames, encoding):
+    """
+    Read a CSV file a batch of rows at a time, with every column as a
+    string, like `csv.DictReader` would
+    """
+    return pyarrow.csv.open_csv(
+        filename,
+        read_options=pyarrow.csv.ReadOptions(block_size=2**24, encoding=encoding),
+        parse_options=pyarrow.csv.ParseOptions(newlines_in_values=True),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={name: pyarrow.string() for name in fieldnames},
+            strings_can_be_null=False,
+            quoted_strings_can_be_null=False,
+        ),
+    )
+
+
+def write_results_parquet(filename, membership, columns, source_column=None):
+    """
+    Write the rows of all the input files of a
+    `shared.results.ClusterMembership` to a Parquet file, with the same
+    columns `shared.results.write_results` writes to a CSV file.
+    Records that are in no cluster have nulls in the cluster columns.
+    """
+    cluster_column, score_column = columns
+
+    writer = None
+    header = None
+    try:
+        for fileno, (row_index, cluster_ids, scores) in enumerate(
+            zip(membership.row_indexes, membership.cluster_ids, membership.scores)
+        ):
+            if header is None:
+                header = row_index.fieldnames
+
+            if isinstance(row_index, ParquetIndex):
+                batches = row_index.batches()
+            else:
+                batches = csv_batches(
+                    row_index.filename, row_index.fieldnames, row_index.encoding
+                )
+
+            start = 0
+            for batch in batches:
+                end = start + batch.num_rows
+                no_cluster = cluster_ids[start:end] < 0
+                extra = {
+                    cluster_column: pyarrow.array(
+                        cluster_ids[start:end], mask=no_cluster
+                    ),
+                    score_column: pyarrow.array(scores[start:end], mask=no_cluster),
+                }
+                if source_column is not None:
+                    extra[source_column] = pyarrow.array(
+                        numpy.full(batch.num_rows, fileno, dtype=numpy.int32)
+                    )
+
+                names = batch.schema.names
+                data = list(extra.values())
+                for name in header:
+                    if name in names:
+                        data.append(batch.column(names.index(name)))
+                    else:
+                        data.append(pyarrow.nulls(batch.num_rows, pyarrow.string()))
+                table = pyarrow.Table.from_arrays(data, names=list(extra) + header)
+
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(filename, table.schema)
+                writer.write_table(table.cast(writer.schema))
+                start = end
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def csv_to_parquet(csv_file, parquet_file, encoding="utf-8"):
+    """
+    Convert a CSV file to a Parquet file with every column as a string
+    """
+    with open(csv_file, encoding=encoding) as f:
+        fieldnames = next(csv.reader(f))
+
+    writer = None
+    try:
+        for batch in csv_batches(csv_file, fieldnames, encoding):
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(parquet_file, batch.schema)
+            writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+# ## Picking CSV or Parquet by the file name
+
+
+def row_index_for(filename):
+    """
+    An empty index of the rows of a CSV or a Parquet file
+    """
+    if is_parquet(filename):
+        return ParquetIndex(filename)
+    return RowIndex(filename)
+
+
+def read_records(filename, clean_row, **kwargs):
+    """
+    Read a CSV or a Parquet file with `shared.csvio.read_csv` or
+    `read_parquet`
+    """
+    if is_parquet(filename):
+        return read_parquet(filename, clean_row, **kwargs)
+    return read_csv(filename, clean_row, **kwargs)
+
+
+def write_results_file(filename, membership, columns, source_column=None):
+    """
+    Write results to a CSV or a Parquet file, depending on its name
+    """
+    if is_parquet(filename):
+        write_results_parquet(filename, membership, columns, source_column)
+    else:
+        with open(filename, "w") as f:
+            write_results(f, membership, columns, source_column)
@@ -0,0 +1,218 @@
+"""
+Keep the block keys of records on disk between runs.
+
+When a settings file has already been learned, most of the time of a
+rerun goes to blocking: every predicate is run on every record again,
+even if the record hasn't changed since the last run. `BlockKeyCache`
+stores the block keys of every record in a SQLite file, under a hash of
+the fields dedupe compares and a hash of the settings file. On the next
+run we only compute block keys for records that are new or have
+changed, or for all records if the settings have changed.
+
+The cache remembers which records it has seen since the last
+`partition`, and `partition` then drops the block keys of every other
+record, like the old versions of records that have changed, so the file
+doesn't grow from one run to the next.
+
+Only predicates that look at one record at a time can be cached. The
+block keys of index predicates, like TF-IDF canopies, depend on all the
+other records too, so we compute those again on every run.
+
+`partition` works like `dedupe.Dedupe.partition`, but gets its block
+keys through the cache.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+
+import dedupe.core
+
+
+def digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def uses_index(predicate):
+    # a compound predicate is made of simple predicates, and a simple
+    # predicate is made of itself
+    return any(hasattr(part, "index") for part in predicate)
+
+
+class BlockKeyCache:
+    """
+    The block keys of records, stored in the SQLite file `filename`, for
+    the settings in `settings_file`. Block keys stored for other
+    settings are dropped, and `prune` drops the ones of records that
+    haven't been seen since it was last called.
+    """
+
+    def __init__(self, filename, settings_file):
+        with open(settings_file, "rb") as f:
+            self.settings = digest(f.read())
+
+        self.con = sqlite3.connect(filename)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS block_keys "
+            "(settings TEXT, record TEXT, block_keys TEXT, "
+            "PRIMARY KEY (settings, record)) WITHOUT ROWID"
+        )
+        self.con.execute("DELETE FROM block_keys WHERE settings != ?", (self.settings,))
+        self.con.commit()
+
+        self.con.execute("CREATE TEMP TABLE seen (record TEXT PRIMARY KEY)")
+
+        self.hits = 0
+        self.misses = 0
+
+    def record_hash(self, record, fields):
+        values = [record[field] for field in fields]
+        return digest(repr(values).encode("utf-8"))
+
+    def fingerprints(self, fingerprinter, fields, records):
+        """
+        Yield `(block_key, record_id)` for `(record_id, record)` pairs,
+        like `fingerprinter(records)` does
+        """
+        predicates = [
+            (":" + str(i), predicate)
+            for i, predicate in enumerate(fingerprinter.predicates)
+        ]
+        cached = [(pred_id, p) for pred_id, p in predicates if not uses_index(p)]
+        uncached = [(pred_id, p) for pred_id, p in predicates if uses_index(p)]
+
+        lookup = self.con.cursor()
+        new = []
+        seen = []
+
+        for record_id, record in records:
+            key = self.record_hash(record, fields)
+            seen.append((key,))
+            lookup.execute(
+                "SELECT block_keys FROM block_keys WHERE settings = ? AND record = ?",
+                (self.settings, key),
+            )
+            row = lookup.fetchone()
+            if row is None:
+                block_keys = [
+                    block_key + pred_id
+                    for pred_id, predicate in cached
+                    for block_key in predicate(record)
+                ]
+                new.append((self.settings, key, json.dumps(block_keys)))
+                self.misses += 1
+            else:
+                block_keys = json.loads(row[0])
+                self.hits += 1
+
+            for block_key in block_keys:
+                yield block_key, record_id
+
+            for pred_id, predicate in uncached:
+                for block_key in predicate(record):
+                    yield block_key + pred_id, record_id
+
+        lookup.close()
+
+        self.con.executemany("INSERT OR REPLACE INTO block_keys VALUES (?, ?, ?)", new)
+        self.con.executemany("INSERT OR IGNORE INTO seen VALUES (?)", seen)
+        self.con.commit()
+
+    def prune(self):
+        """
+        Drop the block keys of the records that haven't been seen since
+        the last time, and return how many there were
+        """
+        cur = self.con.execute(
+            "DELETE FROM block_keys "
+            "WHERE settings = ? AND record NOT IN (SELECT record FROM seen)",
+            (self.settings,),
+        )
+        self.con.execute("DELETE FROM seen")
+        self.con.commit()
+        return cur.rowcount
+
+    def close(self):
+        self.con.close()
+
+
+def model_fields(deduper):
+    fields = []
+    for variable in deduper.data_model.field_variables:
+        if variable.field not in fields:
+            fields.append(variable.field)
+    return fields
+
+
+def pairs(deduper, data_d, cache):
+    """
+    Yield pairs of records that share block keys, like
+    `dedupe.Dedupe.pairs`
+    """
+    fingerprinter = deduper.fingerprinter
+    fingerprinter.index_all(data_d)
+
+    id_type = dedupe.core.sqlite_id_type(data_d)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        con = sqlite3.connect(os.path.join(temp_dir, "blocks.db"))
+        con.execute("pragma journal_mode=off")
+        con.execute(f"CREATE TABLE blocking_map (block_key text, record_id {id_type})")
+        con.executemany(
+            "INSERT INTO blocking_map VALUES (?, ?)",
+            cache.fingerprints(fingerprinter, model_fields(deduper), data_d.items()),
+        )
+
+        fingerprinter.reset_indices()
+
+        con.execute("CREATE INDEX block_key_idx ON blocking_map (block_key)")
+        con.execute("ANALYZE")
+
+        record_pairs = con.execute(
+            """SELECT DISTINCT a.record_id, b.record_id
+               FROM blocking_map a
+               INNER JOIN blocking_map b
+               USING (block_key)
+               WHERE a.record_id < b.record_id"""
+        )
+        for a_record_id, b_record_id in record_pairs:
+            yield (
+                (a_record_id, data_d[a_record_id]),
+                (b_record_id, data_d[b_record_id]),
+            )
+
+        record_pairs.close()
+        con.close()
+
+
+def partition(deduper, data_d, threshold, cache):
+    """
+    Cluster the records like `dedupe.Dedupe.partition`, with block keys
+    from `cache`, and drop the block keys of records that aren't in
+    `data_d` from it
+    """
+    scores = deduper.score(pairs(deduper, data_d, cache))
+    cache.prune()
+
+    clusters = []
+    clustered = set()
+    # if no pair scored above 0, every record is a cluster of its own
+    if len(scores):
+        for record_ids, cluster_scores in deduper.cluster(scores, threshold):
+            clusters.append((record_ids, cluster_scores))
+            clustered.update(record_ids)
+
+    # the scores are in a memory mapped temporary file, unless no pair
+    # scored above 0
+    filename = getattr(scores, "filename", None)
+    del scores
+    if filename:
+        os.remove(filename)
+
+    for record_id in data_d:
+        if record_id not in clustered:
+            clusters.append(((record_id,), (1.0,)))
+
+    return clusters
@@ -0,0 +1,180 @@
+"""
+Keep the document frequencies of the corpora of `Text` and `Set`
+variables on disk between training runs.
+
+A `Text` or `Set` variable counts, for every word or member in its
+corpus, how many documents have it, when it's created. The examples
+create their variables from generators over every record, so every
+training run splits and counts every document again, although the data
+hardly ever changes between runs.
+
+`CorpusCache` keeps the counts in a SQLite file, as one pickled
+dictionary per corpus, under the name of the corpus, with the number of
+documents they were counted from, and a hash of those documents. To get
+the frequencies of a corpus, it goes through the corpus once, only
+hashing the documents, which is much faster than counting their words:
+
+* if the hash of the first documents is the hash of the documents the
+  cache counted, the counts are still good, and only the documents
+  after them, the records appended since, are counted and added,
+* otherwise the corpus changed, and every document is counted again.
+
+`text_variable` and `set_variable` make a `dedupe.variables.Text` or
+`dedupe.variables.Set` with the frequencies from the cache, as if they
+had been given the whole corpus.
+"""
+
+import collections
+import hashlib
+import math
+import pickle
+import sqlite3
+
+import dedupe
+
+
+def words(document):
+    # like `CosineTextSimilarity`
+    return set(document.split())
+
+
+def members(document):
+    # like `CosineSetSimilarity`
+    return set(document)
+
+
+def hash_update(hasher, document):
+    # the repr of a document never has a newline in it
+    hasher.update(repr(document).encode("utf-8") + b"\n")
+
+
+class DocumentFrequencies:
+    """
+    For every token, the number of documents that have it, of
+    `n_docs` documents that aren't empty
+    """
+
+    def __init__(self, counts=None, n_docs=0):
+        self.counts = collections.Counter(counts)
+        self.n_docs = n_docs
+
+    def count(self, document, tokens):
+        if document:
+            self.counts.update(tokens(document))
+            self.n_docs += 1
+
+    def use(self, variable):
+        """
+        Set the document frequencies of the comparator of a `Text` or
+        `Set` variable, the way it sets them from a corpus
+        """
+        comparator = variable.comparator
+        comparator.doc_freq = {
+            token: math.log(self.n_docs / count) for token, count in self.counts.items()
+        }
+        comparator.default_score = math.log(self.n_docs) if self.n_docs else 1.0
+
+
+class CorpusCache:
+    """
+    The document frequencies of corpora, stored in the SQLite file
+    `filename`
+    """
+
+    def __init__(self, filename):
+        self.con = sqlite3.connect(filename)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS corpora "
+            "(name TEXT PRIMARY KEY, length INTEGER, digest TEXT, "
+            "n_docs INTEGER, counts BLOB)"
+        )
+        self.con.commit()
+
+        # documents counted, and documents whose counts came from the
+        # cache
+        self.counted = 0
+        self.cached = 0
+
+    def frequencies(self, name, corpus, tokens=words):
+        """
+        The `DocumentFrequencies` of the corpus `name`. `corpus` is a
+        function that returns an iterable of the documents, which is
+        called a second time if the corpus has changed. `tokens` splits
+        a document into the set of its tokens.
+        """
+        row = self.con.execute(
+            "SELECT length, digest, n_docs, counts FROM corpora WHERE name = ?",
+            (name,),
+        ).fetchone()
+        if row is None:
+            length, digest = 0, hashlib.blake2b().hexdigest()
+            cached = DocumentFrequencies()
+        else:
+            length, digest, n_docs, counts = row
+            cached = DocumentFrequencies(pickle.loads(counts), n_docs)
+
+        hasher = hashlib.blake2b()
+        new = DocumentFrequencies()
+        position = 0
+        unchanged = length == 0
+        for position, document in enumerate(corpus(), 1):
+            if position > length:
+                if not unchanged:
+                    break
+                new.count(document, tokens)
+            hash_update(hasher, document)
+            if position == length:
+                unchanged = hasher.hexdigest() == digest
+
+        if unchanged and position == length:
+            self.cached += cached.n_docs
+            return cached
+
+        if unchanged and position > length:
+            self.counted += new.n_docs
+            self.cached += cached.n_docs
+            new.counts.update(cached.counts)
+            new.n_docs += cached.n_docs
+        else:
+            hasher = hashlib.blake2b()
+            new = DocumentFrequencies()
+            position = 0
+            for position, document in enumerate(corpus(), 1):
+                new.count(document, tokens)
+                hash_update(hasher, document)
+            self.counted += new.n_docs
+
+        self.con.execute(
+            "INSERT OR REPLACE INTO corpora VALUES (?, ?, ?, ?, ?)",
+            (
+                name,
+                position,
+                hasher.hexdigest(),
+                new.n_docs,
+                pickle.dumps(dict(new.counts), pickle.HIGHEST_PROTOCOL),
+            ),
+        )
+        self.con.commit()
+
+        return new
+
+    def text_variable(self, field, corpus_name, corpus, **kwargs):
+        """
+        A `dedupe.variables.Text` for `field`, with the document
+        frequencies of the corpus `corpus_name`
+        """
+        variable = dedupe.variables.Text(field, **kwargs)
+        self.frequencies(corpus_name, corpus, words).use(variable)
+        return variable
+
+    def set_variable(self, field, corpus_name, corpus, **kwargs):
+        """
+        A `dedupe.variables.Set` for `field`, with the document
+        frequencies of the corpus `corpus_name`
+        """
+        variable = dedupe.variables.Set(field, **kwargs)
+        self.frequencies(corpus_name, corpus, members).use(variable)
+        return variable
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,305 @@
+"""
+Read big CSV files into the dictionary of records dedupe wants, using
+all the cores of the machine.
+
+The file is cut into chunks of about `chunk_size` bytes, and each chunk
+is parsed and cleaned in its own process. A chunk can only start at the
+beginning of a record. A newline ends a record only when it isn't inside
+a quoted field, that is, when an even number of quote characters come
+before it in the file, so we find the cut points by counting quotes.
+
+Record IDs are the same no matter how the file is cut, because chunks
+are merged back in file order.
+
+As we go, we can also note where every record starts in the file, in a
+`RowIndex`. Then we only need to keep the fields dedupe compares in
+memory, and can read the full row back from the file whenever we want
+to show it to someone or write it out.
+"""
+
+import array
+import csv
+import io
+import locale
+import multiprocessing
+import os
+
+BLOCK_SIZE = 2**24
+
+
+def count_quotes(f, start, end):
+    """
+    Count the quote characters between two byte offsets
+    """
+    f.seek(start)
+    quotes = 0
+    while start < end:
+        block = f.read(min(BLOCK_SIZE, end - start))
+        if not block:
+            break
+        quotes += block.count(b'"')
+        start += len(block)
+    return quotes
+
+
+def next_record_start(f, offset, quotes):
+    """
+    Find the first record that starts at or after `offset`, given the
+    number of quote characters before `offset`. Returns the byte offset
+    of the record, and the number of quote characters before it.
+    """
+    f.seek(offset)
+    while True:
+        line = f.readline()
+        if not line:
+            return f.tell(), quotes
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            return f.tell(), quotes
+
+
+def record_boundaries(filename, chunk_size):
+    """
+    Returns the header and the byte offsets of the starts of the chunks,
+    followed by the size of the file
+    """
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        header_end, quotes = next_record_start(f, 0, 0)
+        f.seek(0)
+        header = f.read(header_end)
+
+        offsets = [header_end]
+        for target in range(header_end + chunk_size, size, chunk_size):
+            if target <= offsets[-1]:
+                continue
+            quotes += count_quotes(f, offsets[-1], target)
+            # We can't tell where a record starts at `target` itself,
+            # so we look for the end of the line that contains it
+            f.seek(target - 1)
+            if f.read(1) == b"\n":
+                start = target
+                quotes_at_start = quotes
+            else:
+                start, quotes_at_start = next_record_start(f, target, quotes)
+            # Not every newline ends a record; keep going until the
+            # quotes are balanced
+            while quotes_at_start % 2 and start < size:
+                start, quotes_at_start = next_record_start(f, start, quotes_at_start)
+            if start >= size:
+                break
+            offsets.append(start)
+            quotes = quotes_at_start
+
+        offsets.append(size)
+
+    return header, offsets
+
+
+def text(data, encoding):
+    # Read like `open` does by default, with universal newlines
+    return io.TextIOWrapper(io.BytesIO(data), encoding=encoding)
+
+
+class Lines:
+    """
+    Decode bytes into lines for a `csv.reader`, keeping track of how far
+    into the bytes we are. `\\r\\n` line endings become `\\n`, like
+    they do when reading a file opened with `open`.
+    """
+
+    def __init__(self, data, encoding):
+        self.data = data
+        self.encoding = encoding
+        self.position = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= len(self.data):
+            raise StopIteration
+        end = self.data.find(b"\n", self.position) + 1 or len(self.data)
+        line = self.data[self.position : end].decode(self.encoding)
+        self.position = end
+        if line.endswith("\r\n"):
+            line = line[:-2] + "\n"
+        return line
+
+
+def read_chunk(job):
+    """
+    Parse and clean the records in one chunk of the file. Returns a list
+    of `(record_id, offset, record)` tuples, where `record_id` is `None`
+    if the IDs don't come from a column, and `offset` is where the row
+    starts in the file.
+    """
+    filename, start, end, fieldnames, encoding, clean_row, id_column, id_type = job
+
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    lines = Lines(data, encoding)
+    reader = csv.DictReader(lines, fieldnames=fieldnames)
+
+    records = []
+    while True:
+        # The reader doesn't read ahead, so this is where the next row
+        # starts
+        offset = start + lines.position
+        try:
+            row = next(reader)
+        except StopIteration:
+            break
+        record_id = None if id_column is None else id_type(row[id_column])
+        records.append((record_id, offset, clean_row(row)))
+
+    return records
+
+
+class RowIndex:
+    """
+    Where each record's row starts in a CSV file, so that we can read
+    the full row again, by seeking to it, when we need it.
+    """
+
+    def __init__(self, filename, encoding=None):
+        if encoding is None:
+            encoding = locale.getpreferredencoding(False)
+        self.filename = filename
+        self.encoding = encoding
+        self.fieldnames = None
+        self._offsets = array.array("q")
+        self._positions = {}
+        self._file = None
+
+    def add(self, record_id, offset):
+        self._positions[record_id] = len(self._offsets)
+        self._offsets.append(offset)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, record_id):
+        return record_id in self._positions
+
+    def position(self, record_id):
+        """
+        The position of a record's row among all the indexed rows
+        """
+        return self._positions[record_id]
+
+    def row(self, record_id):
+        """
+        Read the full row of a record back from the file, as a
+        dictionary like the ones `csv.DictReader` makes
+        """
+        return self._read(self._offsets[self._positions[record_id]])
+
+    def rows(self):
+        """
+        Yield `(record_id, row)` for every record, in file order
+        """
+        for record_id in self._positions:
+            yield record_id, self.row(record_id)
+
+    def scan(self):
+        """
+        Yield every row as a list of values, in file order, reading the
+        file from top to bottom
+        """
+        with open(self.filename, encoding=self.encoding) as f:
+            reader = csv.reader(f)
+            next(reader)
+            for row in reader:
+                # `csv.DictReader` skips blank lines, so they don't have
+                # a record
+                if row:
+                    yield row
+
+    def _read(self, offset):
+        if self._file is None:
+            self._file = open(self.filename, "rb")
+        self._file.seek(offset)
+        reader = csv.DictReader(
+            (line.decode(self.encoding).replace("\r\n", "\n") for line in self._file),
+            fieldnames=self.fieldnames,
+        )
+        return next(reader)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_csv(
+    filename,
+    clean_row,
+    id_column=None,
+    id_type=int,
+    id_prefix=None,
+    processes=None,
+    chunk_size=2**24,
+    encoding=None,
+    data_d=None,
+    row_index=None,
+):
+    """
+    Read a CSV file into a dictionary of records, or into `data_d` if
+    it is given, for example a `shared.records.RecordStore`. If there
+    is a `row_index`, we add where every record starts in the file to
+    it.
+
+    `clean_row` is called on the dictionary of every row and returns the
+    record. It runs in other processes, so it must be a module level
+    function, or a `functools.partial` of one.
+
+    The key of a record is `id_type(row[id_column])` if there is an
+    `id_column`. Otherwise it's the position of the row in the file,
+    with `id_prefix` in front of it if there is one, as a string.
+    """
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+
+    header, offsets = record_boundaries(filename, chunk_size)
+    (fieldnames,) = csv.reader(text(header, encoding))
+
+    if row_index is not None:
+        row_index.fieldnames = fieldnames
+
+    jobs = [
+        (filename, start, end, fieldnames, encoding, clean_row, id_column, id_type)
+        for start, end in zip(offsets, offsets[1:])
+    ]
+
+    if processes is None:
+        processes = os.cpu_count()
+
+    if len(jobs) < 2 or processes < 2:
+        chunks = map(read_chunk, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        chunks = pool.imap(read_chunk, jobs)
+
+    if data_d is None:
+        data_d = {}
+
+    i = 0
+    try:
+        for chunk in chunks:
+            for record_id, offset, record in chunk:
+                if record_id is None:
+                    record_id = i if id_prefix is None else id_prefix + str(i)
+                data_d[record_id] = record
+                if row_index is not None:
+                    row_index.add(record_id, offset)
+                i += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return data_d
@@ -0,0 +1,350 @@
+"""
+Keep the index of a gazetteer's canonical records on disk, so that a
+later process can attach to it instead of indexing the records again.
+
+`gazetteer.index(canonical)` does three things:
+
+* it indexes the values of some fields for the index predicates, like
+  TF-IDF canopies,
+* it computes the block keys of every canonical record, into a SQLite
+  table,
+* it keeps the canonical records, to compare them with the records we
+  search for.
+
+`save` writes all three to a directory:
+
+* `index.json`, the version of the format, and hashes of the settings
+  file and of the canonical data the index was built from,
+* `predicates.pickle`, the indices of the index predicates,
+* `index.db`, a SQLite file with the block keys of the canonical
+  records, and the records themselves.
+
+`attach` checks that the format version and both hashes still match,
+and points a `StaticGazetteer` at the index. The block keys are queried
+where they are, and the canonical records are read from `index.db` as
+they are needed, by `IndexedRecords`. If anything doesn't match,
+`attach` returns `False` and the records have to be indexed again.
+
+The only memory mapping is SQLite's own, with the `mmap_size` pragma on
+the connection to `index.db`. `predicates.pickle` isn't in a format
+that can be memory mapped: the predicate indices are unpickled, and
+loaded into memory in full, on every attach.
+
+An attached gazetteer is for searching. To index other canonical
+records, index them from scratch and `save` again.
+
+A gazetteer that indexed its records itself can also take records in
+and out of its index one at a time, with `add` and `remove`, instead of
+indexing all of them again. That costs time in proportion to the
+records that change:
+
+* The index predicates of a gazetteer are search predicates. The block
+  key of a canonical record is the id of its own value in the
+  predicate's index, so it doesn't change when other records come and
+  go. Only the records that change get new block keys.
+* The TF-IDF indices count, for every word, how many distinct
+  documents have it. `DocumentCounts` keeps track of how many records
+  have each document, so a document goes into an index with the first
+  record that has it, and comes out with the last one, and the
+  document frequencies stay what they would be if we had indexed from
+  scratch. After every change, the index weighs its words again, which
+  takes time in proportion to the size of its vocabulary.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+from collections.abc import Mapping
+
+from dedupe.tfidf import TfIdfIndex
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+# How much of index.db SQLite may memory map
+MMAP_SIZE = 2**30
+
+
+def file_digest(filename):
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class IndexedRecords(Mapping):
+    """
+    The canonical records in an `index.db`, as a read-only mapping from
+    record id to record
+    """
+
+    def __init__(self, filename):
+        # the gazetteer may be indexed in one thread and searched in
+        # another, like in gazetteer_server.py
+        self.con = sqlite3.connect(filename, check_same_thread=False)
+        self.con.execute("PRAGMA mmap_size = %d" % MMAP_SIZE)
+
+    def __getitem__(self, record_id):
+        row = self.con.execute(
+            "SELECT record FROM records WHERE record_id = ?", (record_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(record_id)
+        return pickle.loads(row[0])
+
+    def __iter__(self):
+        for (record_id,) in self.con.execute("SELECT record_id FROM records"):
+            yield record_id
+
+    def __len__(self):
+        return self.con.execute("SELECT count(*) FROM records").fetchone()[0]
+
+    def close(self):
+        self.con.close()
+
+
+class DocumentCounts:
+    """
+    How many canonical records have each document in the indices of the
+    index predicates of `fingerprinter`. A document is a field value as
+    an index predicate preprocesses it, like the words of a title, so
+    different values can make the same document.
+    """
+
+    def __init__(self, fingerprinter):
+        self.index_fields = fingerprinter.index_fields
+        self.counts = {
+            (field, index_type): collections.Counter()
+            for field, index_types in self.index_fields.items()
+            for index_type in index_types
+        }
+
+    def documents(self, records):
+        for record in records:
+            for field, index_type in self.counts:
+                value = record[field]
+                if value:
+                    predicate = self.index_fields[field][index_type][0]
+                    yield field, index_type, predicate.preprocess(value)
+
+    def count(self, records):
+        """
+        Count the documents of `records`, which have been indexed
+        """
+        for field, index_type, doc in self.documents(records):
+            self.counts[field, index_type][doc] += 1
+
+    def add(self, records):
+        """
+        Count the documents of `records`, and index the ones that no
+        other record has
+        """
+        new = collections.defaultdict(set)
+        for field, index_type, doc in self.documents(records):
+            counts = self.counts[field, index_type]
+            if not counts[doc]:
+                new[field, index_type].add(doc)
+            counts[doc] += 1
+
+        for (field, index_type), docs in new.items():
+            index = self.index_fields[field][index_type][0].index
+            for doc in docs:
+                index.index(doc)
+            self.refresh(field, index_type, index)
+
+    def remove(self, records):
+        """
+        Stop counting the documents of `records`, and unindex the ones
+        that no record has anymore
+        """
+        gone = collections.defaultdict(set)
+        for field, index_type, doc in self.documents(records):
+            counts = self.counts[field, index_type]
+            counts[doc] -= 1
+            if not counts[doc]:
+                del counts[doc]
+                gone[field, index_type].add(doc)
+
+        for (field, index_type), docs in gone.items():
+            index = self.index_fields[field][index_type][0].index
+            for doc in docs:
+                if isinstance(index, TfIdfIndex):
+                    # `TfIdfIndex.unindex` weighs all the words again
+                    # for every document; `refresh` does it once
+                    index._index.unindex_doc(index._doc_to_id.pop(doc))
+                else:
+                    index.unindex(doc)
+            self.refresh(field, index_type, index)
+
+    def refresh(self, field, index_type, index):
+        # like `Fingerprinter.index` does after indexing documents
+        index.initSearch()
+        for predicate in self.index_fields[field][index_type]:
+            predicate.index = index
+            predicate.bust_cache()
+
+
+def document_counts(gazetteer):
+    """
+    `DocumentCounts` of the records `gazetteer` has indexed
+    """
+    counts = DocumentCounts(gazetteer.fingerprinter)
+    counts.count(gazetteer.indexed_data.values())
+    return counts
+
+
+def add(gazetteer, counts, data):
+    """
+    Add the records in `data` to the index of `gazetteer`, which has
+    indexed records before. Records that are already in the index are
+    replaced.
+    """
+    replaced = [record_id for record_id in data if record_id in gazetteer.indexed_data]
+    if replaced:
+        remove(gazetteer, counts, replaced)
+
+    counts.add(data.values())
+
+    con = sqlite3.connect(gazetteer.db)
+    con.executemany(
+        "REPLACE INTO indexed_records VALUES (?, ?)",
+        gazetteer.fingerprinter(data.items(), target=True),
+    )
+    con.commit()
+    con.close()
+
+    gazetteer.indexed_data.update(data)
+
+
+def remove(gazetteer, counts, record_ids):
+    """
+    Remove the records with `record_ids` from the index of `gazetteer`
+    """
+    records = [gazetteer.indexed_data.pop(record_id) for record_id in record_ids]
+
+    counts.remove(records)
+
+    con = sqlite3.connect(gazetteer.db)
+    con.executemany(
+        "DELETE FROM indexed_records WHERE record_id = ?",
+        ((record_id,) for record_id in record_ids),
+    )
+    con.commit()
+    con.close()
+
+
+def predicate_indices(gazetteer):
+    """
+    The index of every kind of index predicate, by field
+    """
+    indices = {}
+    for field, index_types in gazetteer.fingerprinter.index_fields.items():
+        for index_type, predicates in index_types.items():
+            indices.setdefault(field, {})[index_type] = predicates[0].index
+    return indices
+
+
+def metadata(settings_file, canonical_file):
+    return {
+        "format": FORMAT_VERSION,
+        "settings": file_digest(settings_file),
+        "canonical": file_digest(canonical_file),
+    }
+
+
+def save(gazetteer, directory, settings_file, canonical_file):
+    """
+    Write the index of `gazetteer`, which has indexed the records of
+    `canonical_file` with the settings in `settings_file`, to
+    `directory`
+    """
+    os.makedirs(directory, exist_ok=True)
+    metadata_file = os.path.join(directory, "index.json")
+    db_file = os.path.join(directory, "index.db")
+
+    # Until the new index.json is written, the directory holds no valid
+    # index, so an interrupted save is never attached to
+    if os.path.exists(metadata_file):
+        os.remove(metadata_file)
+
+    with open(os.path.join(directory, "predicates.pickle"), "wb") as f:
+        pickle.dump(predicate_indices(gazetteer), f, pickle.HIGHEST_PROTOCOL)
+
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    source = sqlite3.connect(gazetteer.db)
+    con = sqlite3.connect(db_file)
+    source.backup(con)
+    source.close()
+
+    id_type = con.execute(
+        "SELECT type FROM pragma_table_info('indexed_records') WHERE name = 'record_id'"
+    ).fetchone()[0]
+    con.execute(f"CREATE TABLE records (record_id {id_type} PRIMARY KEY, record BLOB)")
+    con.executemany(
+        "INSERT INTO records VALUES (?, ?)",
+        (
+            (record_id, pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+            for record_id, record in gazetteer.indexed_data.items()
+        ),
+    )
+    con.commit()
+    con.close()
+
+    with open(metadata_file, "w") as f:
+        json.dump(metadata(settings_file, canonical_file), f, indent=2)
+        f.write("\n")
+
+
+def attach(gazetteer, directory, settings_file, canonical_file):
+    """
+    Point `gazetteer` at the index in `directory`, if it was built from
+    `canonical_file` with the settings in `settings_file`. Returns
+    whether it was.
+    """
+    metadata_file = os.path.join(directory, "index.json")
+    if not os.path.exists(metadata_file):
+        return False
+
+    with open(metadata_file) as f:
+        saved = json.load(f)
+
+    current = metadata(settings_file, canonical_file)
+    for key in ("format", "settings", "canonical"):
+        if saved.get(key) != current[key]:
+            logger.info("index in %s is out of date, its %s changed", directory, key)
+            return False
+
+    with open(os.path.join(directory, "predicates.pickle"), "rb") as f:
+        indices = pickle.load(f)
+
+    for field, index_types in gazetteer.fingerprinter.index_fields.items():
+        for index_type, predicates in index_types.items():
+            for predicate in predicates:
+                predicate.index = indices[field][index_type]
+                predicate.bust_cache()
+
+    gazetteer.db = os.path.join(directory, "index.db")
+    gazetteer.indexed_data = IndexedRecords(gazetteer.db)
+
+    return True
+
+
+def index(gazetteer, canonical, directory, settings_file, canonical_file):
+    """
+    Attach `gazetteer` to the index in `directory`, or index the
+    `canonical` records, read from `canonical_file`, and save the index
+    there for next time. Returns whether the index was attached.
+    """
+    if attach(gazetteer, directory, settings_file, canonical_file):
+        return True
+
+    gazetteer.index(canonical)
+    save(gazetteer, directory, settings_file, canonical_file)
+    return False
@@ -0,0 +1,122 @@
+"""
+Active learning from the command line, like `dedupe.console_label`, but
+showing every column of the records' rows in the source file, not only
+the fields dedupe compares.
+
+The full rows are read back from the file through a
+`shared.csvio.RowIndex`, so they don't need to be kept in memory. This
+works for records that know their record ID, like the ones a
+`shared.records.RecordStore` hands out. For any other record, we show
+the fields dedupe compares.
+"""
+
+import sys
+
+
+def _print(*args):
+    print(*args, file=sys.stderr)
+
+
+def show_record(record, fields, row_index):
+    record_id = getattr(record, "record_id", None)
+    if record_id is not None and record_id in row_index:
+        row = row_index.row(record_id)
+        for column in row_index.fieldnames:
+            # mark the columns dedupe compares, and skip other columns
+            # that are empty
+            if column in fields:
+                _print("* %s : %s" % (column, row[column]))
+            elif row[column]:
+                _print("  %s : %s" % (column, row[column]))
+    else:
+        for field in fields:
+            _print("* %s : %s" % (field, record[field]))
+    _print()
+
+
+def mark_pair(deduper, record_pair, label):
+    examples = {"distinct": [], "match": []}
+    if label == "unsure":
+        # dedupe learns nothing from a pair that is labeled both ways,
+        # but it won't ask about it again
+        examples["match"].append(record_pair)
+        examples["distinct"].append(record_pair)
+    else:
+        examples[label].append(record_pair)
+    deduper.mark_pairs(examples)
+
+
+def console_label(deduper, row_index):
+    """
+    Label pairs of records that dedupe is uncertain about as duplicates
+    or not. Use 'y', 'n' and 'u' keys to flag duplicates, 'p' to go back
+    to the previous pair and 'f' when you are finished.
+    """
+    fields = []
+    for variable in deduper.data_model.field_variables:
+        if variable.field not in fields:
+            fields.append(variable.field)
+
+    finished = False
+    use_previous = False
+
+    unlabeled = []
+    # We hold on to the last labeled pair, in case the answer needs
+    # to be changed
+    labeled = []
+
+    n_match = len(deduper.training_pairs["match"])
+    n_distinct = len(deduper.training_pairs["distinct"])
+
+    while not finished:
+        if use_previous:
+            record_pair, label = labeled.pop(0)
+            if label == "match":
+                n_match -= 1
+            elif label == "distinct":
+                n_distinct -= 1
+            use_previous = False
+        else:
+            if not unlabeled:
+                unlabeled = deduper.uncertain_pairs()
+            if not unlabeled:
+                break
+            record_pair = unlabeled.pop()
+
+        for record in record_pair:
+            show_record(record, fields, row_index)
+        _print("%d/10 positive, %d/10 negative" % (n_match, n_distinct))
+        _print("Do these records refer to the same thing?")
+
+        if labeled:
+            prompt = "(y)es / (n)o / (u)nsure / (f)inished / (p)revious"
+            valid_responses = {"y", "n", "u", "f", "p"}
+        else:
+            prompt = "(y)es / (n)o / (u)nsure / (f)inished"
+            valid_responses = {"y", "n", "u", "f"}
+
+        user_input = None
+        while user_input not in valid_responses:
+            _print(prompt)
+            user_input = input()
+
+        if user_input == "y":
+            labeled.insert(0, (record_pair, "match"))
+            n_match += 1
+        elif user_input == "n":
+            labeled.insert(0, (record_pair, "distinct"))
+            n_distinct += 1
+        elif user_input == "u":
+            labeled.insert(0, (record_pair, "unsure"))
+        elif user_input == "f":
+            _print("Finished labeling")
+            finished = True
+        elif user_input == "p":
+            use_previous = True
+            unlabeled.append(record_pair)
+
+        while len(labeled) > 1:
+            mark_pair(deduper, *labeled.pop())
+
+    for record_pair, label in labeled:
+        mark_pair(deduper, record_pair, label)
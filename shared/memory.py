@@ -0,0 +1,122 @@
+"""
+Keep a pipeline within a memory budget.
+
+`MemoryBudget` watches the resident memory of this process. The steps
+of a pipeline ask it whether they are getting close to the budget, and
+if they are, they do their work in smaller pieces: smaller batches, or
+fewer things in memory at a time, with the rest on disk. Every time
+that happens, we say so in the log, so that it's easy to see why a run
+was slower than usual.
+
+The resident memory is read from `/proc/self/statm`. Without `/proc`,
+like on macOS, only the peak memory of the process can be measured,
+which never goes down again, so the budget is only logged, and nothing
+shrinks or spills.
+"""
+
+import logging
+import os
+import resource
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """
+    The peak resident memory, in bytes, of this process, or with
+    `resource.RUSAGE_CHILDREN`, of the largest of its child processes
+    that have finished
+    """
+    # `ru_maxrss` is in bytes on macOS, and in kilobytes elsewhere
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024
+    return peak
+
+
+def current_rss():
+    """
+    The resident memory of this process right now, in bytes, or `None`
+    without `/proc`
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def rss():
+    """
+    The resident memory of this process right now, in bytes, or the
+    peak so far if we can't tell
+    """
+    current = current_rss()
+    if current is None:
+        return peak_rss()
+    return current
+
+
+class MemoryBudget:
+    """
+    At most `limit` bytes of resident memory. We are near the budget
+    once we use more than `high_water` of it. If we can't measure the
+    memory we use right now, we are never near it.
+    """
+
+    def __init__(self, limit, high_water=0.8):
+        self.limit = limit
+        self.high_water = high_water
+
+        self.adaptive = current_rss() is not None
+        if not self.adaptive:
+            logger.warning(
+                "can't measure the resident memory without /proc, so "
+                "nothing shrinks or spills to stay within %s",
+                format_size(limit),
+            )
+
+    def used(self):
+        return rss()
+
+    def near(self):
+        return self.adaptive and self.used() > self.limit * self.high_water
+
+    def shrink(self, size, what, minimum=100):
+        """
+        Half of the batch size `size`, if we are near the budget, or
+        `size` otherwise
+        """
+        if size <= minimum or not self.near():
+            return size
+        new_size = max(size // 2, minimum)
+        logger.warning(
+            "using %s of %s memory, %s batch size %d -> %d",
+            format_size(self.used()),
+            format_size(self.limit),
+            what,
+            size,
+            new_size,
+        )
+        return new_size
+
+    def spill(self, what):
+        """
+        Log that `what` goes to disk to stay within the budget
+        """
+        logger.warning(
+            "using %s of %s memory, spilling %s to disk",
+            format_size(self.used()),
+            format_size(self.limit),
+            what,
+        )
+
+
+def format_size(n_bytes):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n_bytes < 1024:
+            return "%.0f %s" % (n_bytes, unit)
+        n_bytes /= 1024
+    return "%.1f TiB" % n_bytes
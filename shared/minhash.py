@@ -0,0 +1,227 @@
+"""
+Block records with long text by MinHash locality sensitive hashing.
+
+The predicates dedupe learns for a `Text` field look at a few words or
+at TF-IDF canopies. On long product descriptions, a predicate on a few
+words is either too weak to find pairs, or so common that its blocks
+hold thousands of records. MinHash-LSH puts two records in the same
+block with a probability that grows with the Jaccard similarity of
+their sets of shingles, the overlapping `shingle_size` character runs
+of the text:
+
+* Every shingle is hashed to a 32 bit number. For `bands * rows` random
+  hash functions `(a * x + b) mod P`, the signature of a record is the
+  smallest hash of any of its shingles, under each function. Two
+  records have the same value at a position of their signatures with a
+  probability equal to the Jaccard similarity of their shingles.
+* The signature is cut into `bands` bands of `rows` values. Records
+  with the same values in a band share a block key. Two records with a
+  Jaccard similarity `s` share at least one of them with a probability
+  of `1 - (1 - s**rows)**bands`, which is an S-curve that's steepest
+  around `(1 / bands)**(1 / rows)`. More bands find more pairs, more
+  rows find fewer, but more similar, pairs.
+
+The signatures of many records are computed at once: the shingle hashes
+of a chunk of records go into one array, every hash function is applied
+to all of them with one numpy operation, and `numpy.minimum.reduceat`
+takes the minimum for every record. Blocking takes time in proportion
+to the length of the text, plus the number of pairs it finds.
+
+`MinHashLSH.pairs` has the signature of `RecordLink.pairs`, so it can
+take its place. With `union`, it can add its pairs to the pairs of the
+learned predicates instead. `pairs_report` prints how many pairs a
+blocking finds, and how many of the labeled matches are among them.
+"""
+
+import collections
+import itertools
+import zlib
+
+import dedupe.serializer
+import numpy
+
+# A prime larger than every 32 bit hash, so that `(a * x + b) mod P`,
+# with `a` and `b` smaller than 2**32, is a random permutation of the
+# hashes and `a * x + b` never overflows 64 bits
+PRIME = 4294967311
+
+BANDS = 30
+ROWS = 3
+SHINGLE_SIZE = 3
+
+# How many shingle hashes to take through the hash functions at once
+CHUNK_SHINGLES = 2**16
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """
+    The 32 bit hashes of the distinct `size` character runs of `text`
+    """
+    data = text.encode("utf-8")
+    if len(data) <= size:
+        runs = {data}
+    else:
+        runs = {data[i : i + size] for i in range(len(data) - size + 1)}
+    return numpy.fromiter((zlib.crc32(run) for run in runs), numpy.uint64, len(runs))
+
+
+class MinHashLSH:
+    """
+    Block records by the MinHash signatures of the text in `fields`,
+    with `bands` bands of `rows` rows. The hash functions are drawn
+    with `seed`, so the same seed always gives the same block keys.
+    """
+
+    def __init__(
+        self,
+        fields,
+        bands=BANDS,
+        rows=ROWS,
+        shingle_size=SHINGLE_SIZE,
+        seed=0,
+    ):
+        self.fields = fields
+        self.bands = bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+
+        rng = numpy.random.default_rng(seed)
+        n_hashes = bands * rows
+        self.a = rng.integers(1, 2**32, n_hashes, dtype=numpy.uint64)[:, None]
+        self.b = rng.integers(0, 2**32, n_hashes, dtype=numpy.uint64)[:, None]
+
+    def text(self, record):
+        return " ".join(record[field] for field in self.fields if record[field])
+
+    def signatures(self, records):
+        """
+        Yield `(record_id, signature)` for the `(record_id, record)`
+        pairs in `records` that have any text, `CHUNK_SHINGLES` shingles
+        at a time
+        """
+        records = iter(records)
+        while True:
+            ids, hashes = [], []
+            n_shingles = 0
+            for record_id, record in records:
+                text = self.text(record)
+                if text:
+                    ids.append(record_id)
+                    hashes.append(shingles(text, self.shingle_size))
+                    n_shingles += len(hashes[-1])
+                    if n_shingles >= CHUNK_SHINGLES:
+                        break
+            if not ids:
+                break
+
+            starts = numpy.cumsum([0] + [len(h) for h in hashes[:-1]])
+            permuted = (self.a * numpy.concatenate(hashes) + self.b) % PRIME
+            minimums = numpy.minimum.reduceat(permuted, starts, axis=1)
+
+            yield from zip(ids, minimums.T)
+
+    def block_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows : (band + 1) * self.rows].tobytes()
+
+    def blocking_map(self, data):
+        """
+        The ids of the records in `data` by block key
+        """
+        blocks = collections.defaultdict(list)
+        for record_id, signature in self.signatures(data.items()):
+            for block_key in self.block_keys(signature):
+                blocks[block_key].append(record_id)
+        return blocks
+
+    def candidates(self, data_1, data_2):
+        """
+        Yield every `(id_1, id_2)` pair of a record in `data_1` and a
+        record in `data_2` that share a block key, once
+        """
+        blocks = self.blocking_map(data_2)
+        for record_id, signature in self.signatures(data_1.items()):
+            matches = set()
+            for block_key in self.block_keys(signature):
+                matches.update(blocks.get(block_key, ()))
+            for match_id in matches:
+                yield record_id, match_id
+
+    def pairs(self, data_1, data_2):
+        """
+        Yield the pairs of records that share a block key, like
+        `RecordLink.pairs`
+        """
+        return record_pairs(self.candidates(data_1, data_2), data_1, data_2)
+
+
+def record_pairs(id_pairs, data_1, data_2):
+    """
+    Yield the `((id_1, record_1), (id_2, record_2))` pairs that
+    `RecordLink.pairs` yields, for `(id_1, id_2)` pairs
+    """
+    for id_1, id_2 in id_pairs:
+        yield (id_1, data_1[id_1]), (id_2, data_2[id_2])
+
+
+def pair_ids(pairs):
+    """
+    Yield the `(id_1, id_2)` pairs of pairs of records, like the ones
+    `RecordLink.pairs` yields
+    """
+    for (id_1, _), (id_2, _) in pairs:
+        yield id_1, id_2
+
+
+def union(*id_pairs):
+    """
+    Yield the distinct `(id_1, id_2)` pairs of several blockings
+    """
+    seen = set()
+    for pair in itertools.chain(*id_pairs):
+        if pair not in seen:
+            seen.add(pair)
+            yield pair
+
+
+def labeled_matches(training_file, data_1, data_2, fields):
+    """
+    The `(id_1, id_2)` pairs of the records in `data_1` and `data_2`
+    that are labeled as matches in `training_file`. The labeled records
+    are found by the values of `fields`.
+    """
+
+    def ids_by_values(data):
+        return {
+            tuple(record[field] for field in fields): record_id
+            for record_id, record in data.items()
+        }
+
+    ids_1 = ids_by_values(data_1)
+    ids_2 = ids_by_values(data_2)
+
+    with open(training_file) as f:
+        training = dedupe.serializer.read_training(f)
+
+    matches = set()
+    for record_1, record_2 in training["match"]:
+        id_1 = ids_1.get(tuple(record_1[field] for field in fields))
+        id_2 = ids_2.get(tuple(record_2[field] for field in fields))
+        if id_1 is not None and id_2 is not None:
+            matches.add((id_1, id_2))
+    return matches
+
+
+def pairs_report(name, id_pairs, matches):
+    """
+    Count the distinct `(id_1, id_2)` pairs a blocking finds, and the
+    share of the labeled `matches` among them, and print them on a line
+    with `name`. Without labeled matches, the recall is `nan`.
+    """
+    n_pairs = 0
+    found = 0
+    for pair in id_pairs:
+        n_pairs += 1
+        found += pair in matches
+    recall = found / len(matches) if matches else float("nan")
+    print("%-28s %12d %8.3f" % (name, n_pairs, recall))
@@ -0,0 +1,119 @@
+"""
+Fast, memoized versions of the `preProcess` cleaning functions of the
+examples.
+
+Every example cleans its cells the same way: transliterate to ASCII
+with Unidecode, make a few substitutions, strip surrounding whitespace
+and quotes and lowercase. Only the substitutions differ, so each example
+describes them as an ordered list of `(pattern, replacement)` rules and
+gets a `Normalizer` back.
+
+The rules are compiled once. Runs of rules that replace a single,
+literal character are folded into one `str.translate` table, and the
+remaining patterns each become one compiled regex. Columns like city,
+state or zip repeat the same few values over and over, so the cleaned
+value of every distinct input is also kept in a bounded LRU cache.
+"""
+
+import functools
+import operator
+import re
+
+from unidecode import unidecode
+
+REGEX_METACHARACTERS = frozenset(".^$*+?{}[]\\|()")
+
+
+def is_literal_character(pattern):
+    return len(pattern) == 1 and pattern not in REGEX_METACHARACTERS
+
+
+def compile_rules(rules):
+    """
+    Turn an ordered list of `(pattern, replacement)` rules into a list
+    of steps, each a function from string to string, that give the same
+    result as applying the rules one after another with `re.sub`.
+
+    A translate table replaces all its characters at once, so a single
+    character rule only joins the current table if no earlier rule in
+    the table replaces the same character or produces it.
+    """
+    steps = []
+    table = {}
+
+    for pattern, replacement in rules:
+        if is_literal_character(pattern):
+            if ord(pattern) in table or any(
+                pattern in produced for produced in table.values()
+            ):
+                steps.append(operator.methodcaller("translate", table))
+                table = {}
+            table[ord(pattern)] = replacement
+            continue
+
+        if table:
+            steps.append(operator.methodcaller("translate", table))
+            table = {}
+
+        steps.append(functools.partial(re.compile(pattern).sub, replacement))
+
+    if table:
+        steps.append(operator.methodcaller("translate", table))
+
+    return steps
+
+
+class Normalizer:
+    """
+    Clean a single cell of data, like the `preProcess` functions of the
+    examples.
+
+    `rules` is an ordered list of `(pattern, replacement)` regex
+    substitutions that run after transliteration. If `null_empty` is
+    true, an empty result becomes `None`, so dedupe knows the value is
+    missing. At most `cache_size` cleaned values are remembered.
+    """
+
+    def __init__(self, rules, null_empty=True, cache_size=2**16):
+        self.rules = list(rules)
+        self.null_empty = null_empty
+        self.cache_size = cache_size
+        self._setup()
+
+    def _setup(self):
+        self._steps = compile_rules(self.rules)
+        self._cached = functools.lru_cache(maxsize=self.cache_size)(self.normalize)
+
+    def normalize(self, column):
+        """
+        Clean a value without looking in the cache
+        """
+        column = unidecode(column)
+        for step in self._steps:
+            column = step(column)
+        column = column.strip().strip('"').strip("'").lower().strip()
+        if self.null_empty and not column:
+            column = None
+        return column
+
+    def __call__(self, column):
+        return self._cached(column)
+
+    def cache_info(self):
+        return self._cached.cache_info()
+
+    def cache_clear(self):
+        self._cached.cache_clear()
+
+    # The cache can't be pickled, so a copy sent to another process
+    # starts with an empty one
+    def __getstate__(self):
+        return {
+            "rules": self.rules,
+            "null_empty": self.null_empty,
+            "cache_size": self.cache_size,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
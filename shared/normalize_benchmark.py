@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+Compare the `Normalizer` each example uses for `preProcess` with the
+cleaning function it replaced, on the example data.
+
+For every example we check that both give exactly the same value for
+every cell, and then time a pass over all the cells with the old
+function, with the normalizer and an empty cache, and with the
+normalizer again once its cache is warm.
+
+Run it from the root of the repository:
+
+    python shared/normalize_benchmark.py
+"""
+
+import csv
+import importlib.util
+import os
+import re
+import time
+
+from unidecode import unidecode
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+# ## The cleaning functions the normalizers replaced
+
+
+def csv_preProcess(column):
+    column = unidecode(column)
+    column = re.sub("  +", " ", column)
+    column = re.sub("\n", " ", column)
+    column = column.strip().strip('"').strip("'").lower().strip()
+    if not column:
+        column = None
+    return column
+
+
+def officers_preProcess(column):
+    column = unidecode(column)
+    column = re.sub("  +", " ", column)
+    column = re.sub("\n", " ", column)
+    column = column.strip().strip('"').strip("'").lower().strip()
+    return column
+
+
+def record_linkage_preProcess(column):
+    column = unidecode(column)
+    column = re.sub("\n", " ", column)
+    column = re.sub("-", "", column)
+    column = re.sub("/", " ", column)
+    column = re.sub("'", "", column)
+    column = re.sub(",", "", column)
+    column = re.sub(":", " ", column)
+    column = re.sub("  +", " ", column)
+    column = column.strip().strip('"').strip("'").lower().strip()
+    if not column:
+        column = None
+    return column
+
+
+def gazetteer_preProcess(column):
+    column = unidecode(column)
+    column = re.sub("\n", " ", column)
+    column = re.sub("-", "", column)
+    column = re.sub("/", " ", column)
+    column = re.sub("'", "", column)
+    column = re.sub(",", "", column)
+    column = re.sub(":", " ", column)
+    column = re.sub(" +", " ", column)
+    column = column.strip().strip('"').strip("'").lower().strip()
+    if not column:
+        column = None
+    return column
+
+
+# Each example, with the function it used to have, and some data to
+# clean with it. There's no officers data in the repository, so we
+# borrow the csv example's.
+CASES = [
+    (
+        "csv_example/csv_example.py",
+        csv_preProcess,
+        ["csv_example/csv_example_messy_input.csv"],
+    ),
+    (
+        "extended-variables/officers.py",
+        officers_preProcess,
+        ["csv_example/csv_example_messy_input.csv"],
+    ),
+    (
+        "record_linkage_example/record_linkage_example.py",
+        record_linkage_preProcess,
+        [
+            "record_linkage_example/AbtBuy_Abt.csv",
+            "record_linkage_example/AbtBuy_Buy.csv",
+        ],
+    ),
+    (
+        "gazetteer_example/gazetteer_example.py",
+        gazetteer_preProcess,
+        [
+            "gazetteer_example/data/AbtBuy_Abt.csv",
+            "gazetteer_example/data/AbtBuy_Buy.csv",
+        ],
+    ),
+]
+
+
+def load_example(path):
+    path = os.path.join(ROOT, path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def cells(filenames):
+    values = []
+    for filename in filenames:
+        with open(os.path.join(ROOT, filename)) as f:
+            for row in csv.DictReader(f):
+                values.extend(row.values())
+    return values
+
+
+def timed(function, values):
+    start = time.perf_counter()
+    for value in values:
+        function(value)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    print(
+        "%-24s %8s %8s %10s %10s %10s"
+        % ("example", "cells", "distinct", "old", "cold", "warm")
+    )
+
+    for path, legacy, filenames in CASES:
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            example = load_example(path)
+        except ImportError as e:
+            print("%-24s skipped, %s" % (name, e))
+            continue
+
+        normalizer = example.preProcess
+        values = cells(filenames)
+
+        for value in values:
+            assert normalizer.normalize(value) == legacy(value), value
+
+        old_time = timed(legacy, values)
+        normalizer.cache_clear()
+        cold_time = timed(normalizer, values)
+        warm_time = timed(normalizer, values)
+
+        print(
+            "%-24s %8d %8d %9.3fs %9.3fs %9.3fs"
+            % (name, len(values), len(set(values)), old_time, cold_time, warm_time)
+        )
@@ -0,0 +1,81 @@
+"""
+A compact stand-in for the dictionary of records that dedupe takes.
+
+A dictionary of dictionaries is easy to work with, but every record
+carries its own hash table, and a copy of every column of the input,
+whether dedupe ever compares it or not. For a few short fields, that
+overhead can be many times the size of the data itself.
+
+`RecordStore` only keeps the fields the data model uses. It stores them
+as one list per field, and keeps a single copy of every distinct value
+in a column, so a city or a state that appears on a hundred thousand
+rows is only in memory once. Looking up a record builds a small
+dictionary on the fly, so the store can be passed anywhere dedupe
+expects a dictionary of records.
+"""
+
+import collections.abc
+
+
+class Record(dict):
+    """
+    A record that remembers its record ID, so that we can find it in
+    the source file again, for example when a person labels it.
+    """
+
+    __slots__ = ("record_id",)
+
+
+class RecordStore(collections.abc.Mapping):
+    """
+    Records keyed by record ID, stored column by column. Only the
+    values of `fields` are kept.
+
+        >>> data_d = RecordStore(["name", "city"])
+        >>> data_d[1] = {"name": "pat", "city": "chicago", "notes": "..."}
+        >>> data_d[1]
+        {'name': 'pat', 'city': 'chicago'}
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self._columns = [[] for _ in self.fields]
+        self._values = [{} for _ in self.fields]
+        self._positions = {}
+
+    def _shared(self, column, value):
+        try:
+            return self._values[column].setdefault(value, value)
+        except TypeError:
+            # unhashable values can't be shared
+            return value
+
+    def __setitem__(self, record_id, record):
+        values = [self._shared(i, record[field]) for i, field in enumerate(self.fields)]
+
+        position = self._positions.get(record_id)
+        if position is None:
+            self._positions[record_id] = len(self._positions)
+            for column, value in zip(self._columns, values):
+                column.append(value)
+        else:
+            for column, value in zip(self._columns, values):
+                column[position] = value
+
+    def __getitem__(self, record_id):
+        position = self._positions[record_id]
+        record = Record(
+            (field, column[position])
+            for field, column in zip(self.fields, self._columns)
+        )
+        record.record_id = record_id
+        return record
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, record_id):
+        return record_id in self._positions
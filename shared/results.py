@@ -0,0 +1,105 @@
+"""
+Write the input rows back out with the cluster each record belongs to.
+
+The examples used to build a dictionary from every record ID to a small
+dictionary with its cluster ID and score, and then read every input
+file again through a `csv.DictReader` and write it out through a
+`csv.DictWriter`. That dictionary of dictionaries can be as big as the
+records themselves.
+
+`ClusterMembership` keeps the cluster ID and score of every record in
+two arrays per input file, indexed by the position of the record's row
+in its file, which a `shared.csvio.RowIndex` already knows. Since the
+arrays are in file order, `write_results` can then stream every file
+from top to bottom with `RowIndex.scan` and a plain `csv.writer`, and
+put the cluster columns in front of each row as it goes.
+"""
+
+import csv
+
+import numpy
+
+NO_CLUSTER = -1
+
+
+class ClusterMembership:
+    """
+    The cluster ID and score of the records in one or more input files,
+    each with the `RowIndex` that was filled while reading it, or a
+    `shared.arrowio.ParquetIndex` for a Parquet file.
+    """
+
+    def __init__(self, *row_indexes):
+        self.row_indexes = row_indexes
+        self.cluster_ids = [
+            numpy.full(len(row_index), NO_CLUSTER, dtype=numpy.int64)
+            for row_index in row_indexes
+        ]
+        self.scores = [
+            numpy.zeros(len(row_index), dtype=numpy.float32)
+            for row_index in row_indexes
+        ]
+
+    def add(self, record_id, cluster_id, score):
+        for i, row_index in enumerate(self.row_indexes):
+            if record_id in row_index:
+                position = row_index.position(record_id)
+                self.cluster_ids[i][position] = cluster_id
+                self.scores[i][position] = score
+                return
+        raise KeyError(record_id)
+
+
+def cluster_columns(cluster_ids, scores):
+    """
+    Yield the cluster ID and score to write for every row, or empty
+    columns for a record that isn't in any cluster
+    """
+    for cluster_id, score in zip(cluster_ids.tolist(), scores):
+        if cluster_id == NO_CLUSTER:
+            yield ["", ""]
+        else:
+            yield [cluster_id, score]
+
+
+def write_results(f_output, membership, columns, source_column=None):
+    """
+    Write the rows of all the input files of `membership` to `f_output`,
+    in order, with a cluster ID and a score column in front of them,
+    named by `columns`. If there is a `source_column`, it holds the
+    number of the input file each row came from.
+
+    The header of the first file is used for all of them. Columns of
+    later files are matched to it by name.
+    """
+    writer = csv.writer(f_output)
+
+    header = None
+    for fileno, (row_index, cluster_ids, scores) in enumerate(
+        zip(membership.row_indexes, membership.cluster_ids, membership.scores)
+    ):
+        fieldnames = row_index.fieldnames
+        if header is None:
+            header = fieldnames
+            extra_columns = list(columns)
+            if source_column is not None:
+                extra_columns.append(source_column)
+            writer.writerow(extra_columns + header)
+
+        if fieldnames == header:
+            reorder = None
+        else:
+            reorder = [
+                fieldnames.index(name) if name in fieldnames else None
+                for name in header
+            ]
+
+        rows = row_index.scan()
+        for row, extra in zip(rows, cluster_columns(cluster_ids, scores)):
+            if reorder is not None:
+                row = ["" if i is None or i >= len(row) else row[i] for i in reorder]
+            elif len(row) < len(header):
+                row += [""] * (len(header) - len(row))
+            if source_column is not None:
+                extra.append(fileno)
+            writer.writerow(extra + row)
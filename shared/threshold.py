@@ -0,0 +1,172 @@
+"""
+Pick a gazetteer's threshold from a sample of the messy records.
+
+dedupe 1.x had `gazetteer.threshold(messy, recall_weight)`, which
+blocked and scored every messy record to pick a threshold, and then
+`match` blocked and scored all of them again. `estimate` only searches
+a stratified sample of the messy records:
+
+* The records are split into strata by which of the fields the model
+  compares are missing. Missing fields change the scores a lot, so
+  every pattern of missing fields is sampled in proportion to how
+  common it is, and at least `MIN_PER_STRATUM` times.
+* The best score of every sampled record is the probability that it
+  matches its best candidate. Weighing every record by how many records
+  of its stratum it stands for, we pick the threshold that maximizes the
+  expected F-score, like dedupe 1.x did, with `recall_weight` times as
+  much weight on recall as on precision.
+* Resampling the sample within its strata gives a bootstrap confidence
+  interval for the threshold.
+
+If none of the sampled records has a candidate, there are no scores to
+pick a threshold from, and the estimate's threshold is `None`.
+
+The search results of the sampled records are kept, so the match pass
+only has to search the other records, and `accepted` applies the
+threshold to the kept results.
+"""
+
+import collections
+import random
+
+import numpy
+
+from .blockcache import model_fields
+
+MIN_PER_STRATUM = 5
+
+N_BOOTSTRAP = 200
+
+ThresholdEstimate = collections.namedtuple(
+    "ThresholdEstimate", ["threshold", "low", "high", "sample_size", "results"]
+)
+
+
+def missing(value):
+    return value is None or value == ""
+
+
+def stratify(records, fields):
+    """
+    The ids of `records` by which of `fields` they are missing
+    """
+    strata = collections.defaultdict(list)
+    for record_id, record in records.items():
+        strata[tuple(missing(record[field]) for field in fields)].append(record_id)
+    return strata
+
+
+def allocate(strata, size):
+    """
+    How many records to sample from every stratum, in proportion to its
+    size, but at least `MIN_PER_STRATUM`, or all of them
+    """
+    total = sum(len(ids) for ids in strata.values())
+    return {
+        stratum: min(len(ids), max(MIN_PER_STRATUM, round(size * len(ids) / total)))
+        for stratum, ids in strata.items()
+    }
+
+
+def best_threshold(scores, weights, recall_weight=1.0):
+    """
+    The threshold that maximizes the expected F-score of the scores
+    above it, if records with the scores `scores` match with those
+    probabilities, and every record stands for `weights` records
+    """
+    order = numpy.argsort(scores)[::-1]
+    scores = scores[order]
+    weights = weights[order]
+
+    expected_dupes = numpy.cumsum(scores * weights)
+    recall = expected_dupes / expected_dupes[-1]
+    precision = expected_dupes / numpy.cumsum(weights)
+
+    f_score = recall * precision / (recall + recall_weight**2 * precision)
+
+    # a threshold keeps all the records with a score or none of them,
+    # so only the last record of every run of equal scores is a place
+    # to cut
+    last = numpy.flatnonzero(numpy.append(scores[1:] < scores[:-1], True))
+    best = last[numpy.argmax(f_score[last])]
+
+    # a search keeps the scores above its threshold, so to keep the
+    # best one and all the scores above it, the threshold is the next
+    # lower score
+    if best + 1 < len(scores):
+        return scores[best + 1]
+    return 0.0
+
+
+def estimate(
+    gazetteer,
+    messy,
+    sample_size,
+    recall_weight=1.0,
+    n_bootstrap=N_BOOTSTRAP,
+    seed=None,
+):
+    """
+    Estimate a threshold for matching the `messy` records with
+    `gazetteer`, from a stratified sample of about `sample_size` of
+    them. Returns the threshold, the bounds of its 95% confidence
+    interval, the number of records sampled, and the search results of
+    the sampled records, with their best match at any score. The
+    threshold and its bounds are `None` if no sampled record has a
+    candidate.
+    """
+    rng = random.Random(seed)
+
+    strata = stratify(messy, model_fields(gazetteer))
+    sample = {
+        stratum: rng.sample(strata[stratum], n)
+        for stratum, n in allocate(strata, sample_size).items()
+    }
+
+    data = {record_id: messy[record_id] for ids in sample.values() for record_id in ids}
+    results = dict(gazetteer.search(data, threshold=0.0, n_matches=1))
+
+    # the best score of every sampled record that has a candidate, by
+    # stratum, and the number of records every sampled record of the
+    # stratum stands for
+    strata_scores = []
+    for stratum, ids in sample.items():
+        stratum_scores = numpy.array(
+            [results[i][0][1] for i in ids if results[i]], dtype=float
+        )
+        if len(stratum_scores):
+            strata_scores.append((stratum_scores, len(strata[stratum]) / len(ids)))
+
+    if not strata_scores:
+        return ThresholdEstimate(None, None, None, len(data), results)
+
+    def threshold(resample):
+        scores = [resample(stratum_scores) for stratum_scores, _ in strata_scores]
+        weights = [
+            numpy.full(len(stratum_scores), weight)
+            for stratum_scores, (_, weight) in zip(scores, strata_scores)
+        ]
+        return best_threshold(
+            numpy.concatenate(scores), numpy.concatenate(weights), recall_weight
+        )
+
+    point = threshold(lambda s: s)
+
+    np_rng = numpy.random.default_rng(seed)
+    bootstrap = [
+        threshold(lambda s: np_rng.choice(s, len(s))) for _ in range(n_bootstrap)
+    ]
+    low, high = numpy.percentile(bootstrap, [2.5, 97.5])
+
+    return ThresholdEstimate(float(point), float(low), float(high), len(data), results)
+
+
+def accepted(results, threshold):
+    """
+    Search results, like `gazetteer.search` yields them, with only the
+    matches that score above `threshold`
+    """
+    for record_id, matches in results.items():
+        yield record_id, tuple(
+            (match_id, score) for match_id, score in matches if score > threshold
+        )
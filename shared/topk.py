@@ -0,0 +1,136 @@
+"""
+Generate candidate pairs by TF-IDF similarity, instead of blocking.
+
+dedupe blocks records with the predicates it learned, like "shares the
+first five characters of the title" or "is in the same TF-IDF canopy of
+the description". For product catalogs that can go both ways: a
+predicate that's too strict misses a pair whose titles are written
+differently, and one that's too loose puts every "black 16GB" product
+in the same huge block, so some records have thousands of candidates.
+
+`TopKCandidates` gives every record exactly its `k` most similar
+records on the other side instead:
+
+* `index` builds a sparse TF-IDF matrix of the words of `fields` in the
+  canonical records. Every row is normalized, so the product of two
+  rows is their cosine similarity.
+* For `chunk_size` records at a time, `nearest` multiplies their TF-IDF
+  matrix with the canonical one, which gives a sparse matrix of the
+  similarities of every record of the chunk with every canonical record
+  that shares a word with it, and keeps the `k` largest of every row.
+
+The number of pairs to score is never more than `k` times the number of
+records, so the time it takes to score them, and the latency of a
+search, doesn't depend on how the data happens to block. The memory of
+a chunk grows with `chunk_size` times the number of canonical records
+that share a word with a record.
+
+`blocks` has the signature of `Gazetteer.blocks`, and `pairs` the one
+of `RecordLink.pairs`, so either can take their place.
+"""
+
+import itertools
+
+import numpy
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+TOP_K = 10
+
+CHUNK_SIZE = 1000
+
+
+def document(record, fields):
+    return " ".join(record[field] for field in fields if record[field])
+
+
+def top_k(similarities, k):
+    """
+    Yield the columns and values of the `k` largest values of every row
+    of the sparse matrix `similarities`, from the largest down
+    """
+    similarities = similarities.tocsr()
+    for row in range(similarities.shape[0]):
+        start, end = similarities.indptr[row], similarities.indptr[row + 1]
+        values = similarities.data[start:end]
+        columns = similarities.indices[start:end]
+        if len(values) > k:
+            largest = numpy.argpartition(-values, k)[:k]
+            values, columns = values[largest], columns[largest]
+        order = numpy.argsort(-values, kind="stable")
+        yield columns[order], values[order]
+
+
+class TopKCandidates:
+    """
+    The `k` canonical records most similar to a record, by the TF-IDF
+    cosine similarity of the words in `fields`
+    """
+
+    def __init__(self, fields, k=TOP_K, chunk_size=CHUNK_SIZE):
+        self.fields = fields
+        self.k = k
+        self.chunk_size = chunk_size
+
+    def index(self, canonical):
+        """
+        Index the `canonical` records, a mapping of records by id. The
+        mapping is kept to look up the records of candidate pairs.
+        """
+        self.canonical = canonical
+        self.ids = list(canonical)
+        self.vectorizer = TfidfVectorizer(sublinear_tf=True, dtype=numpy.float32)
+        matrix = self.vectorizer.fit_transform(
+            document(canonical[record_id], self.fields) for record_id in self.ids
+        )
+        # the transpose, so that a chunk times it is chunk by canonical
+        self.matrix = matrix.T.tocsr()
+
+    def nearest(self, data):
+        """
+        Yield `(record_id, ((canonical_id, similarity), ...))` for every
+        record in `data`, with its `k` most similar canonical records
+        """
+        records = iter(data.items())
+        while True:
+            chunk = list(itertools.islice(records, self.chunk_size))
+            if not chunk:
+                break
+
+            similarities = (
+                self.vectorizer.transform(
+                    document(record, self.fields) for _, record in chunk
+                )
+                @ self.matrix
+            )
+            for (record_id, _), (columns, values) in zip(
+                chunk, top_k(similarities, self.k)
+            ):
+                yield record_id, tuple(
+                    (self.ids[column], float(value))
+                    for column, value in zip(columns, values)
+                )
+
+    def blocks(self, data):
+        """
+        Yield, for every record in `data` that shares a word with a
+        canonical record, a list of `((record_id, record), (canonical_id,
+        canonical_record))` pairs with its nearest canonical records,
+        like `Gazetteer.blocks`
+        """
+        for record_id, neighbours in self.nearest(data):
+            if neighbours:
+                record = data[record_id]
+                yield [
+                    ((record_id, record), (canonical_id, self.canonical[canonical_id]))
+                    for canonical_id, _ in neighbours
+                ]
+
+    def pairs(self, data_1, data_2):
+        """
+        Index the records of `data_2`, and yield every record of
+        `data_1` paired with its nearest records of `data_2`, like
+        `RecordLink.pairs`
+        """
+        self.index(data_2)
+        for block in self.blocks(data_1):
+            yield from block
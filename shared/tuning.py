@@ -0,0 +1,207 @@
+"""
+Pick the number of worker processes and the batch sizes for this
+machine, instead of hard coding them.
+
+A calibration run times a few short probes on a sample of the data:
+
+* `calibrate_cores` scores the same sample of record pairs with
+  different numbers of worker processes,
+* `calibrate_batches` runs an I/O step, like a `COPY`, with different
+  batch sizes.
+
+For each, we keep the setting with the best throughput whose memory
+use stays within the budget. More workers or bigger batches have to be
+clearly faster to be picked, because they also cost more memory. If not
+even the smallest setting fits, we use the smallest setting anyway.
+
+The choices are saved to a profile, a small JSON file, that later runs
+load and apply with `load_profile`.
+"""
+
+import json
+import os
+import re
+import resource
+import time
+
+from .memory import peak_rss
+
+# A bigger setting is only picked if it is at least this much faster
+MIN_SPEEDUP = 1.05
+
+# How many record pairs the probe for the memory of a worker process
+# scores
+PROBE_PAIRS = 1000
+
+UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+
+def parse_size(text):
+    """
+    A number of bytes from a size like `512M`, `2G` or `1048576`
+
+        >>> parse_size("2G")
+        2147483648
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*", text.lower())
+    if match is None:
+        raise ValueError("not a size: %r" % text)
+    number, unit = match.groups()
+    return int(float(number) * UNITS[unit])
+
+
+def load_profile(filename):
+    """
+    The settings saved by a calibration run, or an empty dictionary if
+    there hasn't been one
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_profile(filename, profile):
+    with open(filename, "w") as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def total_memory():
+    """
+    The physical memory of this machine, in bytes
+    """
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def worker_memory(deduper, record_pairs):
+    """
+    The peak resident memory, in bytes, of a worker process scoring
+    pairs, from scoring the first `PROBE_PAIRS` of `record_pairs` with
+    two of them
+    """
+    original = deduper.num_cores
+    deduper.num_cores = 2
+    try:
+        scores = deduper.score(iter(record_pairs[:PROBE_PAIRS]))
+    finally:
+        deduper.num_cores = original
+
+    # if no pair scored above 0, the scores aren't in a file
+    filename = getattr(scores, "filename", None)
+    del scores
+    if filename:
+        os.remove(filename)
+
+    return peak_rss(resource.RUSAGE_CHILDREN)
+
+
+def core_candidates(max_cores=None):
+    """
+    1, 2, 4, ... up to the number of CPUs, and the number of CPUs
+    """
+    if max_cores is None:
+        max_cores = os.cpu_count() or 1
+    candidates = [1]
+    while candidates[-1] * 2 <= max_cores:
+        candidates.append(candidates[-1] * 2)
+    if candidates[-1] != max_cores:
+        candidates.append(max_cores)
+    return candidates
+
+
+def pick(results, default):
+    """
+    From `(setting, throughput)` tuples in increasing order of cost, the
+    setting to use, or `default` if there are none
+    """
+    if not results:
+        return default
+
+    best_setting, best_throughput = results[0]
+    for setting, throughput in results[1:]:
+        if throughput > best_throughput * MIN_SPEEDUP:
+            best_setting, best_throughput = setting, throughput
+    return best_setting
+
+
+def calibrate_cores(deduper, record_pairs, max_memory=None, candidates=None):
+    """
+    Score `record_pairs`, a list of pairs of records, with every number
+    of worker processes in `candidates`, and return the best number and
+    a list of `(num_cores, pairs per second)` tuples.
+
+    We estimate the memory a number of workers needs from the peak
+    memory of this process plus that many times the memory of a worker,
+    which we measure with a probe first, and skip numbers that wouldn't
+    fit in `max_memory` bytes. With a single core, dedupe scores in
+    threads of this process, so it needs no worker memory.
+    """
+    if candidates is None:
+        candidates = core_candidates()
+
+    per_worker = 0
+    if max_memory is not None and max(candidates) > 1:
+        per_worker = worker_memory(deduper, record_pairs)
+
+    original = deduper.num_cores
+    results = []
+    try:
+        for num_cores in candidates:
+            own = peak_rss()
+            n_workers = num_cores if num_cores > 1 else 0
+            if max_memory is not None and own + n_workers * per_worker > max_memory:
+                break
+
+            deduper.num_cores = num_cores
+            start = time.perf_counter()
+            scores = deduper.score(iter(record_pairs))
+            elapsed = time.perf_counter() - start
+
+            filename = getattr(scores, "filename", None)
+            del scores
+            if filename:
+                os.remove(filename)
+
+            results.append((num_cores, len(record_pairs) / elapsed))
+    finally:
+        deduper.num_cores = original
+
+    return pick(results, candidates[0]), results
+
+
+def calibrate_batches(run, sizes, max_memory=None):
+    """
+    Call `run(size)` for every batch size in `sizes`, smallest first.
+    `run` does a timed unit of I/O and returns the number of rows and
+    bytes it moved. Returns the best size and a list of `(size, rows
+    per second)` tuples.
+
+    A batch of `size` rows takes about `size` times the average row in
+    memory. Once a batch has told us the size of the average row, bigger
+    sizes where that is more than a tenth of `max_memory` bytes aren't
+    run.
+    """
+    sizes = sorted(sizes)
+    results = []
+    row_bytes = None
+    for size in sizes:
+        if max_memory is not None and row_bytes is not None:
+            if size * row_bytes > max_memory / 10:
+                break
+
+        start = time.perf_counter()
+        rows, n_bytes = run(size)
+        elapsed = time.perf_counter() - start
+        if not rows:
+            continue
+
+        row_bytes = n_bytes / rows
+        results.append((size, rows / elapsed))
+
+    return pick(results, sizes[0]), results
+
+
+def print_results(name, results, unit):
+    for setting, throughput in results:
+        print("  %s %-8s %12.0f %s" % (name, setting, throughput, unit))